@@ -0,0 +1,80 @@
+# =============================================================
+#   Batch runner: many programs and inputs across a process pool
+# =============================================================
+# Every worker process is handed the list of programs once, decodes a
+# program the first time one of its runs comes up and keeps it for the
+# rest of the batch, so interpreter startup and decoding are paid once
+# per worker. Each run gets a fresh VM, its input text and its own
+# captured output (see runProgram).
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+from .smolbitCore import *
+
+# the batch's programs and the ones decoded so far, or the result of a
+# failed load, per worker (see _start)
+_programs = []
+_decoded = {}
+_cache = None
+_options = {}
+
+
+def runCaptured(program, text=None, **options):
+    """Run a program with text (or nothing) as its input and return
+    {"status", "error", "output"}.
+
+    program is a Program or anything VM accepts, options go to VM (limits
+    such as max_steps or timeout, say). status is the exit code
+    (0 when the program just ends), error the exception that stopped it,
+    if any, and output everything it printed, input prompts included."""
+    result = runProgram(program, text or "", **options)
+    error = None if result.error is None else _describe(result.error)
+    return {"status": result.status, "error": error, "output": result.output}
+
+
+def _describe(error):
+    return f"{type(error).__name__}: {error}"
+
+
+def _start(programs, cache, options):
+    global _cache, _options
+    _programs[:] = programs
+    _decoded.clear()
+    _cache = cache
+    _options = options
+
+
+def _run(job):
+    index, text = job
+    program = _decoded.get(index)
+    if program is None:
+        try:
+            bs = load_bitcode(_programs[index])
+            program = _cache.program(bs) if _cache is not None else Program(bs)
+            program.fuse()
+        except Exception as e:
+            # a program that cannot be loaded fails its own jobs, not the batch
+            program = {"status": 1, "error": _describe(e), "output": ""}
+        _decoded[index] = program
+    if isinstance(program, dict):
+        return dict(program)
+    return runCaptured(program, text, **_options)
+
+
+def runBatch(programs, inputs=None, workers=None, cache=None, **options):
+    """Run every program with every input across a pool of worker processes.
+
+    programs are paths, '0'/'1' strings or .smbt bytes; inputs are texts
+    read as input lines, one run each (None: a single run without input).
+    workers defaults to one per core, a Cache, when given, keeps the
+    decoded programs between batches, and options go to every run's VM.
+    Returns the runCaptured results, each with its "program" and "input"
+    index, program by program."""
+    programs = list(programs)
+    inputs = [None] if inputs is None else list(inputs)
+    jobs = [(p, text) for p in range(len(programs)) for text in inputs]
+    workers = workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(workers, initializer=_start, initargs=(programs, cache, options)) as pool:
+        results = pool.map(_run, jobs, chunksize=max(1, len(jobs) // (4 * workers)))
+        return [dict(zip(("program", "input"), divmod(n, len(inputs))), **result)
+                for n, result in enumerate(results)]
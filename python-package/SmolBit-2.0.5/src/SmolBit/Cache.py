@@ -0,0 +1,145 @@
+# =============================================================
+#   On-disk cache of compiled and decoded programs
+# =============================================================
+# Entries are files named by a SHA-256 of what produced them (the
+# source and compile options, or the bitstream) and the package
+# version, so a new release never reads an old entry. The least
+# recently used entries are removed once the directory outgrows its
+# limit. Every write goes through a temporary file and os.replace, so
+# processes sharing the directory never see half an entry, and a cache
+# that cannot be read or written only makes things slower.
+#
+# The directory is $SMOLBIT_CACHE, or smolbit under $XDG_CACHE_HOME
+# (~/.cache by default); SMOLBIT_CACHE set to an empty string turns
+# the default cache off. $SMOLBIT_CACHE_SIZE overrides the limit.
+
+import hashlib
+import os
+import tempfile
+from . import __version__
+from .smolbitCore import *
+from .SyntaxChecker import checker
+from .Converter import convert
+
+CACHE_LIMIT = 64 << 20  # bytes
+
+
+class Cache:
+    """A directory of cache entries holding at most limit bytes."""
+
+    def __init__(self, path=None, limit=None):
+        if path is None:
+            base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+            path = os.path.join(base, "smolbit")
+        if limit is None:
+            limit = int(os.environ.get("SMOLBIT_CACHE_SIZE") or CACHE_LIMIT)
+        self.path = path
+        self.limit = limit
+
+    # ---------------------------------------------------------
+    # Entries
+    # ---------------------------------------------------------
+    def key(self, kind, *parts):
+        """The name of the entry for kind made from parts (bytes or str)."""
+        digest = hashlib.sha256(f"{__version__}\0{kind}".encode())
+        for part in parts:
+            part = part.encode() if isinstance(part, str) else bytes(part)
+            digest.update(len(part).to_bytes(8, "little"))
+            digest.update(part)
+        return f"{kind}-{digest.hexdigest()}"
+
+    def get(self, key):
+        """The bytes stored under key, or None."""
+        path = os.path.join(self.path, key)
+        try:
+            with open(path, "rb") as file:
+                data = file.read()
+            os.utime(path)  # the modification time orders eviction
+        except OSError:
+            return None
+        return data
+
+    def put(self, key, data):
+        """Store data under key, then evict down to the limit."""
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=self.path, prefix=".tmp-")
+            try:
+                with os.fdopen(fd, "wb") as file:
+                    file.write(data)
+                os.replace(tmp, os.path.join(self.path, key))
+            except BaseException:
+                os.remove(tmp)
+                raise
+        except OSError:
+            return
+        self.evict()
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits its limit."""
+        entries = []
+        try:
+            with os.scandir(self.path) as it:
+                for entry in it:
+                    if not entry.name.startswith(".") and entry.is_file():
+                        stat = entry.stat()
+                        entries.append((stat.st_mtime, stat.st_size, entry.path))
+        except OSError:
+            return
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.limit:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        """Remove every entry."""
+        limit, self.limit = self.limit, -1
+        self.evict()
+        self.limit = limit
+
+    # ---------------------------------------------------------
+    # Programs
+    # ---------------------------------------------------------
+    def compile(self, source, **options):
+        """convert(source, **options) after a syntax check, both skipped
+        when the same source was compiled with the same options before.
+
+        Returns the .smbt bytes, or None on a compilation error (which is
+        not cached). as_bits and file are not accepted here."""
+        key = self.key("smbt", source, repr(sorted(options.items())))
+        data = self.get(key)
+        if data is None:
+            checker(source).check()
+            data = convert(source, **options)
+            if data is None:
+                return None
+            self.put(key, data)
+        return data
+
+    def program(self, bs):
+        """The decoded Program of a BitStream, restored from the cache when
+        the same bitstream was decoded before."""
+        key = self.key("program", str(bs.length), bs.data)
+        data = self.get(key)
+        if data is not None:
+            try:
+                return Program.loads(bs, data)
+            except (EOFError, ValueError, TypeError):
+                pass  # a damaged entry is replaced below
+        program = Program(bs)
+        self.put(key, program.dumps())
+        return program
+
+
+def defaultCache():
+    """The Cache programs use unless told otherwise, or None when
+    SMOLBIT_CACHE is set to an empty string."""
+    path = os.environ.get("SMOLBIT_CACHE")
+    if path == "":
+        return None
+    return Cache(path)
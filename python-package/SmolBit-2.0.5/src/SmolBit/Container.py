@@ -0,0 +1,96 @@
+# =============================================================
+#   .smbt container: header, block index and bitstream
+# =============================================================
+# A raw .smbt file is the bitstream alone, zero padded to a whole
+# byte, so its exact length is lost and the VM has to decode it to
+# find where blocks end. A container stores what the VM would work
+# out, ahead of the same bitstream (all integers little-endian):
+#
+#   magic      4 bytes   b"SMBT"
+#   version    u8        CONTAINER_VERSION
+#   flags      u8        0, reserved
+#   reserved   u16       0
+#   bits       u64       exact length of the bitstream in bits
+#   records    u32       number of instruction records
+#   blocks     u32       entries in the block table
+#   block table          (opener, end) record numbers of every block
+#   bitstream            (bits + 7) // 8 bytes
+#
+# Records are numbered from 0 in bitstream order, one per instruction
+# except NOPs (opcode 000) and manipulations with mode 6 or 7, which
+# have no record; every ] is a record. This rule is part of the format:
+# a decoder that numbered records differently needs a new version.
+#
+# load_bitcode recognises a container by its magic and falls back to
+# reading a raw bitstream otherwise.
+
+import struct
+from .smolbitCore import *
+
+MAGIC = b"SMBT"
+CONTAINER_VERSION = 1
+
+_HEADER = struct.Struct("<4sBBHQII")
+_ENTRY = struct.Struct("<II")
+
+
+class Index:
+    """The tables of a container: record count and block ends.
+
+    ends maps each block opener's record number to that of its ]."""
+
+    def __init__(self, records, ends):
+        self.records = records
+        self.ends = ends
+
+
+def isContainer(data):
+    """Whether data (bytes-like) starts with a container header."""
+    return bytes(data[:len(MAGIC)]) == MAGIC and len(data) >= _HEADER.size
+
+
+def packContainer(data, length=None):
+    """Wrap a bitstream (packed bytes as returned by convert, or a '0'/'1'
+    string) in a container. length is its exact size in bits, all of data
+    by default; the bitstream is decoded once to build the block table."""
+    bs = BitStream(data, length=length)
+    ends = []
+    opened = []
+    records = 0
+    try:
+        for op, a, b, c in iter_records(bs):
+            if op in BLOCK_OPS:
+                opened.append(records)
+            elif op == OP_END and opened:
+                ends.append((opened.pop(), records))
+            records += 1
+    except RuntimeError:
+        pass  # an unclosed block: the VM reports it on loading, as for a raw file
+    ends.sort()
+    payload = bytes(bs.data[:(bs.length + 7) // 8])
+    return b"".join([
+        _HEADER.pack(MAGIC, CONTAINER_VERSION, 0, 0, bs.length, records, len(ends)),
+        b"".join(_ENTRY.pack(*entry) for entry in ends),
+        payload,
+    ])
+
+
+def readContainer(data, debug=False):
+    """Return a BitStream over a container's bitstream, holding the exact
+    bit length and the container's Index as bs.index.
+
+    data is any bytes-like object (an mmap works) and is not copied."""
+    if not isContainer(data):
+        raise ValueError("not a SmolBit container")
+    magic, version, flags, _, bits, records, nblocks = _HEADER.unpack_from(data)
+    if version > CONTAINER_VERSION:
+        raise ValueError(f"unsupported SmolBit container version {version}")
+    view = memoryview(data)
+    pos = _HEADER.size
+    if len(view) < pos + nblocks * _ENTRY.size + (bits + 7) // 8:
+        raise ValueError("truncated SmolBit container")
+    ends = dict(_ENTRY.iter_unpack(view[pos:pos + nblocks * _ENTRY.size]))
+    pos += nblocks * _ENTRY.size
+    bs = BitStream(view[pos:pos + (bits + 7) // 8], debug, bits)
+    bs.index = Index(records, ends)
+    return bs
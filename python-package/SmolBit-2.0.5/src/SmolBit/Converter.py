@@ -1,3 +1,8 @@
+import os
+import re
+from .Optimizer import optimizeCode
+from .Container import packContainer
+
 codes_3 = {
     # ----- NOP -----
     'NOP': "000",
@@ -94,90 +99,257 @@ def binaryToBytes(binary:str):
     byte = byte.to_bytes((len(binary) // 8), byteorder="big")
     return byte
 
+# codes_3 as (value, width) pairs for BitWriter
+_CODES = {token: (int(code, 2), len(code)) for token, code in codes_3.items()}
+
+class BitWriter:
+    """Packs codes MSB first into a bytearray through an integer accumulator.
+
+    Only whole bytes are moved to data; the 0-7 bits after them wait in
+    the accumulator until more codes arrive or the writer is closed."""
+
+    def __init__(self):
+        self.data = bytearray()
+        self.acc = 0
+        self.nbits = 0   # bits waiting in acc
+        self.length = 0  # bits written in total
+
+    def write(self, value, width):
+        acc = (self.acc << width) | value
+        nbits = self.nbits + width
+        if nbits >= 8:
+            keep = nbits & 7
+            self.data += (acc >> keep).to_bytes(nbits >> 3, "big")
+            acc &= (1 << keep) - 1
+            nbits = keep
+        self.acc = acc
+        self.nbits = nbits
+        self.length += width
+
+    def tokens(self, split):
+        """Write the codes of a splitCode token list; KeyError on an unknown token."""
+        codes = _CODES
+        data = self.data
+        acc, nbits, length = self.acc, self.nbits, self.length
+        for token in split:
+            value, width = codes[token]
+            acc = (acc << width) | value
+            nbits += width
+            length += width
+            if nbits >= 32:
+                keep = nbits & 7
+                data += (acc >> keep).to_bytes(nbits >> 3, "big")
+                acc &= (1 << keep) - 1
+                nbits = keep
+        self.acc, self.nbits, self.length = acc, nbits, length
+
+    def take(self):
+        """Remove and return the whole bytes written so far."""
+        if self.nbits >= 8:
+            self.write(0, 0)
+        out = bytes(self.data)
+        self.data.clear()
+        return out
+
+    def close(self):
+        """Zero-pad the last partial byte and return everything not yet taken."""
+        if self.nbits:
+            length = self.length
+            self.write(0, -self.nbits % 8)
+            self.length = length  # padding is not part of the program
+        return self.take()
+
+# Characters that only decorate the source and are dropped before splitting
+_DECORATION = str.maketrans("", "", "[()")
+_BRACES = str.maketrans("", "", "{}")
+
+# Comments and strings are cut out of the source first; what is left
+# between them is split on whitespace and every word is broken into
+# one/two character tokens or three character mnemonics.
+_PIECES = re.compile(r""";[^;]*;?|"[^"]*"?|'[^']*'?""")
+_WORD = re.compile(r"[0-9a-f\]=<>!]|IF|.{1,3}", re.DOTALL)
+_CACHED_WORD = 16  # longer words (sources without spaces) are not worth caching
+
+_ESCAPES = {
+    'n': "\n",
+    'r': "\r",
+    't': "\t",
+    "\\": "\\",
+    "'": "'",
+    '"': '"',
+    "a": "\a",
+    "b": "\b",
+    "f": "\f",
+    "v": "\v"
+}
+# a run of backslashes escapes the character after it
+_ESCAPE = re.compile(r"\\+(.?)", re.DOTALL)
+
+def _unescape(match):
+    return _ESCAPES.get(match[1], "\uFFFD") if match[1] else ""
+
+def _split(bitcode, split, words):
+    """Append the tokens of bitcode (already free of decoration) to split,
+    caching each word's tokens in words. Returns False on an unclosed comment."""
+    extend = split.extend
+
+    def plain(text):
+        for word in text.split():
+            tokens = words.get(word)
+            if tokens is None:
+                tokens = _WORD.findall(word)
+                if len(word) <= _CACHED_WORD:
+                    words[word] = tokens
+            extend(tokens)
+
+    pos = 0
+    for match in _PIECES.finditer(bitcode):
+        plain(bitcode[pos:match.start()])
+        pos = match.end()
+        piece = match[0]
+        if piece[0] == ";":
+            if len(piece) < 2 or piece[-1] != ";":
+                return False
+            continue
+        if not split or split[-1] != "DPI":
+            raise ValueError("Unexpected quote")
+        split.pop()
+        if len(piece) < 2 or piece[-1] != piece[0]:
+            continue  # unclosed string: dropped like the DPI before it
+        data = _ESCAPE.sub(_unescape, piece[1:-1]).encode()
+        split.append("DPM")
+        extend(len(data).to_bytes(2).hex())
+        extend(data.hex())
+    plain(bitcode[pos:])
+    return True
+
+def _unclosed():
+    print("Unclosed comment: please ensure all comments are closed correctly and try again")
+
+def _illegal(split, offset=0):
+    """Report the first token of split that is not in codes_3."""
+    for i, ch in enumerate(split):
+        if ch not in codes_3:
+            print(f"COMPILATION ERROR: Illegal character '{ch}' found at position {offset + i}")
+            print(f"Context: ...{split[max(0, i-5):i+5]}...")
+            return
+
 def splitCode(bitcode:str):
     split = []
-    bitcode = bitcode.replace("[", "").replace("(", "").replace(")", "")
-    singles = "0123456789abcdef]=<>!"
-    doubles = ["IF"]
-    quotes = ['"', "'"]
-    escapes = {
-        'n': "\n",
-        'r': "\r",
-        't': "\t",
-        "\\": "\\",
-        "'": "'",
-        '"': '"',
-        "a": "\a",
-        "b": "\b",
-        "f": "\f",
-        "v": "\v"
-    }
-    activeQuote = None
-    skip=False
-    quoteChars = ""
-    quoteEscape = False
-    skipL = 0
-    for i, ch in enumerate(bitcode):
-        if(ch == ";" and activeQuote == None):
-            skip = not skip
-            continue
-        if(ch == activeQuote):
-            activeQuote = None
-            split.append("DPM")
-            quoteChars = [char.encode().hex() for char in quoteChars]
-            split.extend(list((len(''.join(["".join(_ for _ in quoteChars)]))//2).to_bytes(2).hex()))
-            for char in quoteChars:
-                split.extend(list(char))
-            quoteChars = ""
-            continue
-        if(activeQuote != None):
-            if(ch == "\\"):
-                quoteEscape = True
-            elif(quoteEscape):
-                quoteChars += escapes.get(ch, "\uFFFD")
-                quoteEscape = False
-            else:
-                quoteChars += ch
-            continue
-        if(skip):
-            continue
-        if(skipL):
-            skipL-=1
-            continue
-        if ch.isspace():
-            continue
-        if ch in singles:
-            split.append(ch)
-        elif ch in quotes:
-            if split[-1] != "DPI":
-                raise ValueError("Unexpected quote")
-            activeQuote = ch
-            split.pop()
-        elif bitcode[i:i+2] in doubles:
-            split.append(bitcode[i:i+2])
-            skipL = 1
-        else:
-            split.append(bitcode[i:i+3])
-            skipL = 2
-    if(skip):
-        print("Unclosed comment: please ensure all comments are closed correctly and try again")
+    if not _split(bitcode.translate(_DECORATION), split, {}):
+        _unclosed()
         return None
     return split
 
-def convert(bitcode:str, file:str=False):
-    bitcode = splitCode(bitcode.replace("[", "").replace("(", "").replace(")", "").replace("{", "").replace("}", ""))
-    
-    bits = ""
-    for i, ch in enumerate(bitcode):
-
-        if ch in codes_3:
-            bits += codes_3[ch]
-        else:
-            print(f"COMPILATION ERROR: Illegal character '{ch}' found at position {i}")
-            print(f"Context: ...{bitcode[max(0, i-5):i+5]}...")
-            return None
+def convert(bitcode:str, file:str=False, as_bits=False, optimize=False, unroll_budget=0, container=False):
+    """Compile SmolBit source to packed .smbt bytes, or to a '0'/'1'
+    string with as_bits=True. optimize runs the passes in Optimizer over
+    the tokens first, unrolling loops when given an unroll_budget.
+    With container=True the bytes (and file) are a container holding the
+    exact bit length and block index (see Container).
+    Returns None on a compilation error."""
+    bitcode = splitCode(bitcode.translate(_BRACES))
+    if bitcode is None:
+        return None
+    if optimize or unroll_budget:
+        bitcode = optimizeCode(bitcode, unroll_budget=unroll_budget)
+    writer = BitWriter()
+    try:
+        writer.tokens(bitcode)
+    except KeyError:
+        _illegal(bitcode)
+        return None
+    raw = writer.close()
+    data = packContainer(raw, writer.length) if container else raw
     if(file):
         file = open(file, "wb")
-        file.write(binaryToBytes(bits))
+        file.write(data)
         file.close()
-    return bits
\ No newline at end of file
+    if as_bits:
+        return format(int.from_bytes(raw, "big"), f"0{len(raw) * 8}b")[:writer.length]
+    return data
+
+# -------------------------------------------------------------
+# Streaming
+# -------------------------------------------------------------
+_IGNORED = str.maketrans("", "", "[(){}")
+_LAST_SPACE = re.compile(r"\s\S*\Z")
+
+def _cut(buffer):
+    """Split a buffer that more source will follow into (complete, carry).
+
+    complete ends outside any comment or string and between tokens; carry
+    is what has to wait for the next chunk: at most one token, or an
+    unfinished string. An unfinished comment carries
+    over as just its ';', since nothing inside it is ever used."""
+    last = None
+    for last in _PIECES.finditer(buffer):
+        pass
+    if last is not None and last.end() == len(buffer):
+        piece = last[0]
+        if piece[0] == ";" and (len(piece) < 2 or piece[-1] != ";"):
+            return buffer[:last.start()], ";"
+        if len(piece) < 2 or piece[-1] != piece[0]:
+            if len(piece) > 0xFFFF + 1:
+                raise OverflowError("DPI string longer than 65535 bytes")
+            return buffer[:last.start()], piece
+        return buffer, ""
+    start = last.end() if last is not None else 0
+    space = _LAST_SPACE.search(buffer, start)
+    word = space.start() + 1 if space else start
+    # a word is tokenized from its start, so it can be cut before its
+    # last token, the only one more text could still change (IN, I)
+    cut = len(buffer)
+    for token in _WORD.finditer(buffer, word):
+        cut = token.start()
+    return buffer[:cut], buffer[cut:]
+
+def convertStream(source, dest, chunk=1 << 16):
+    """Compile a SmolBit source to .smbt bytes without holding either in memory.
+
+    source is a path or a text file object and dest a path or a binary file
+    object. The source is read chunk characters at a time and the bytes of
+    each chunk are written out before the next is read. Returns the number
+    of bits written, or None on a compilation error (a dest path is then
+    removed)."""
+    src = open(source, "r") if isinstance(source, str) else source
+    out = open(dest, "wb") if isinstance(dest, str) else dest
+    writer = BitWriter()
+    words = {}
+    split = []
+    done = 0  # tokens written so far, for error positions
+    carry = ""
+    ok = False
+    try:
+        while True:
+            text = src.read(chunk)
+            buffer = carry + text.translate(_IGNORED)
+            if text:
+                buffer, carry = _cut(buffer)
+            if not _split(buffer, split, words):
+                _unclosed()
+                return None
+            # the last token waits in case a string follows and needs its DPI
+            last = split.pop() if text and split else None
+            try:
+                writer.tokens(split)
+            except KeyError:
+                _illegal(split, done)
+                return None
+            done += len(split)
+            out.write(writer.take())
+            split = [last] if last is not None else []
+            if len(words) > 4096:
+                words.clear()
+            if not text:
+                break
+        out.write(writer.close())
+        ok = True
+        return writer.length
+    finally:
+        if src is not source:
+            src.close()
+        if out is not dest:
+            out.close()
+            if not ok:
+                os.remove(dest)
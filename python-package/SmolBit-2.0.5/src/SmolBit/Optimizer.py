@@ -0,0 +1,602 @@
+# =============================================================
+#   Optimizer: rewrites splitCode tokens before bit emission
+# =============================================================
+# The tokens are parsed into a tree of instructions, each a tuple
+# (op, args, body) where body is the list of instructions inside a
+# block and None otherwise. The passes rewrite that tree, which is then
+# turned back into tokens. Token lists that do not parse as whole
+# instructions (unclosed blocks, hand-made bit tricks) are left alone.
+#
+# In the tree LDI/LD2/LD3/LD4 are all ("LD", (r, value)) and PG1-PG8 are
+# ("PG", (page,)); both get their shortest encoding back on emission.
+# A `]` at the top level, which halts the program, is ("]", ()).
+
+_HEX = "0123456789abcdef"
+_CONDS = "=<>!"
+_BLOCKS = {"IF", "REP", "DEF", "FOR", "VFR", "WHL"}
+
+# operands after each mnemonic: "r" a register (or function id) nibble,
+# "c" a condition, a number n an n-digit hex immediate
+_OPERANDS = {
+    "NOP": (), "EXO": (), "ERR": (),
+    "INC": ("r",), "DEC": ("r",), "CLZ": ("r",), "CLI": ("r",), "PUS": ("r",), "POP": ("r",),
+    "ADD": ("r", "r"), "SUB": ("r", "r"), "MUL": ("r", "r"), "DIV": ("r", "r"),
+    "SET": ("r", "r"), "POW": ("r", "r"), "ROT": ("r", "r"),
+    "LDI": ("r", 2), "LD2": ("r", 4), "LD3": ("r", 6), "LD4": ("r", 8),
+    "DPU": ("r",), "DPD": ("r",), "DPH": ("r",), "DPI": (2,), "DPM": (4,),
+    "IF": ("r", "c", "r"), "REP": ("r",), "DEF": ("r",), "UDF": ("r",), "CLL": ("r",),
+    "FOR": ("r", 2), "VFR": ("r", "r"), "WHL": ("r", "c", "r"),
+    "INH": ("r",), "IND": ("r",),
+}
+_PAGES = {f"PG{n + 1}": n for n in range(8)}
+_LOADS = ("LDI", "LD2", "LD3", "LD4")
+
+# instructions whose only effect is writing register args[0]
+_WRITES = {"INC", "DEC", "CLZ", "CLI", "LD", "SET", "ADD", "SUB", "MUL", "DIV", "POW", "ROT"}
+_ARITH = {"ADD", "SUB", "MUL", "DIV", "POW", "ROT"}
+_LOOPS = {"REP", "FOR", "VFR", "WHL"}
+# what a partially unrolled REP body may contain: no halts, calls, page
+# switches or instructions that can raise
+_PARTIAL = _WRITES | {"NOP", "PUS", "DPD", "DPH", "DPI", "DPM", "IF"}
+MASK = 0xFFFFFFFF
+
+
+class _Unparsable(Exception):
+    """The tokens are not a sequence of whole instructions."""
+
+
+# -------------------------------------------------------------
+# Tokens <-> instruction tree
+# -------------------------------------------------------------
+def parseTokens(split):
+    """Parse a splitCode token list into an instruction tree (see above)."""
+    pos = 0
+
+    def take(n):
+        nonlocal pos
+        if pos + n > len(split):
+            raise _Unparsable()
+        tokens = split[pos:pos + n]
+        pos += n
+        return tokens
+
+    def number(n):
+        digits = take(n)
+        if not all(d in _HEX for d in digits):
+            raise _Unparsable()
+        return int("".join(digits), 16)
+
+    def block(top):
+        nonlocal pos
+        out = []
+        while pos < len(split):
+            op = split[pos]
+            pos += 1
+            if op == "]":
+                if not top:
+                    return out
+                out.append(("]", (), None))
+                continue
+            if op in _PAGES:
+                out.append(("PG", (_PAGES[op],), None))
+                continue
+            spec = _OPERANDS.get(op)
+            if spec is None:
+                raise _Unparsable()
+            args = []
+            for kind in spec:
+                if kind == "c":
+                    cond = take(1)[0]
+                    if cond not in _CONDS:
+                        raise _Unparsable()
+                    args.append(_CONDS.index(cond))
+                else:
+                    args.append(number(1 if kind == "r" else kind))
+            if op == "DPM":
+                args = [bytes(number(2) for _ in range(args[0]))]
+            elif op in _LOADS:
+                op = "LD"
+            out.append((op, tuple(args), block(False) if op in _BLOCKS else None))
+        if not top:
+            raise _Unparsable()
+        return out
+
+    return block(True)
+
+
+def _load(r, value):
+    """The shortest instruction setting register r to value."""
+    if value == 0:
+        return ("CLZ", (r,), None)
+    if value == r:
+        return ("CLI", (r,), None)
+    return ("LD", (r, value), None)
+
+
+def emitTokens(code, out=None):
+    """Turn an instruction tree back into splitCode tokens."""
+    out = [] if out is None else out
+    for op, args, body in code:
+        if op == "LD":
+            r, value = args
+            n = max(1, (value.bit_length() + 7) // 8)
+            out.append(_LOADS[n - 1])
+            out.append(_HEX[r])
+            out.extend(f"{value:0{2 * n}x}")
+        elif op == "PG":
+            out.append(f"PG{args[0] + 1}")
+        elif op == "DPM":
+            out.append("DPM")
+            out.extend(len(args[0]).to_bytes(2).hex())
+            out.extend(args[0].hex())
+        else:
+            out.append(op)
+            for kind, arg in zip(_OPERANDS.get(op, ()), args):
+                if kind == "c":
+                    out.append(_CONDS[arg])
+                elif kind == "r":
+                    out.append(_HEX[arg])
+                else:
+                    out.extend(f"{arg:0{kind}x}")
+        if body is not None:
+            emitTokens(body, out)
+            out.append("]")
+    return out
+
+
+# -------------------------------------------------------------
+# Helpers shared by the passes
+# -------------------------------------------------------------
+def _loaded(ins):
+    """The value a CLZ/CLI/LD instruction loads, None for anything else."""
+    op, args, _ = ins
+    if op == "CLZ":
+        return 0
+    if op == "CLI":
+        return args[0]
+    if op == "LD":
+        return args[1]
+    return None
+
+
+def _changes_page(code):
+    """Whether running code may leave a different page active (PG or CLL,
+    DEF bodies aside since defining a function runs nothing)."""
+    for op, args, body in code:
+        if op == "PG" or op == "CLL":
+            return True
+        if body is not None and op != "DEF" and _changes_page(body):
+            return True
+    return False
+
+
+# -------------------------------------------------------------
+# Peephole pass
+# -------------------------------------------------------------
+def _reads(ins):
+    """The registers a _WRITES instruction reads."""
+    op, args, _ = ins
+    if op in ("CLZ", "CLI", "LD"):
+        return ()
+    if op == "SET":
+        return args[1:]
+    return args
+
+
+def _overwrites(ins):
+    """Whether ins sets register args[0] without reading it."""
+    op, args, _ = ins
+    return op in ("CLZ", "CLI", "LD") or (op == "SET" and args[0] != args[1])
+
+
+def _peephole(code, page):
+    """Peephole over one instruction list entered on page (None if not
+    known); returns the new list and the page active after it."""
+    out = []
+    for ins in code:
+        op, args, body = ins
+        if op == "NOP" or (op == "SET" and args[0] == args[1]):
+            continue
+        if op == "PG":
+            if args[0] == page:
+                continue
+            if out and out[-1][0] == "PG":
+                out.pop()
+            page = args[0]
+            out.append(ins)
+            continue
+        if body is not None:
+            if op == "DEF":
+                body = _peephole(body, None)[0]
+            else:
+                moves = _changes_page(body)
+                entry = page if op == "IF" or not moves else None
+                body = _peephole(body, entry)[0]
+                page = None if moves else page
+            out.append((op, args, body))
+            continue
+        if op == "CLL":
+            page = None
+
+        if out and out[-1][2] is None and op in _WRITES:
+            r = args[0]
+            prev = out[-1]
+            value = _loaded(prev)
+            if op in ("INC", "DEC") and value is not None and prev[1][0] == r:
+                out[-1] = _load(r, (value + (1 if op == "INC" else -1)) & 0xFF)
+                continue
+            if _overwrites(ins):
+                # earlier writes of r that nothing read since are dead
+                j = len(out) - 1
+                while j >= 0 and out[j][0] in _WRITES:
+                    if out[j][1][0] == r:
+                        del out[j]
+                    elif r in _reads(out[j]):
+                        break
+                    j -= 1
+        out.append(ins)
+    return out, page
+
+
+def peephole(code):
+    """Drop NOPs, SET r r and page switches that change nothing, fold
+    INC/DEC into the load before them and drop loads overwritten unread."""
+    return _peephole(code, 0)[0]
+
+
+# -------------------------------------------------------------
+# Constant propagation
+# -------------------------------------------------------------
+def _arith(op, v1, v2):
+    """Result of an arithmetic instruction, as VM.arithmetic computes it."""
+    if op == "ADD": res = v1 + v2
+    elif op == "SUB": res = v1 - v2
+    elif op == "MUL": res = v1 * v2
+    elif op == "DIV": res = 0 if v2 == 0 else v1 // v2
+    elif op == "POW": res = (v1 ** v2) if v2 < 16 else 0
+    else: res = int(v1 ** (1 / v2)) if v2 != 0 else 0
+    return res & MASK
+
+
+def _test(cond, v1, v2):
+    return (v1 == v2, v1 <= v2, v1 >= v2, v1 != v2)[cond]
+
+
+def _walk(code):
+    """Every instruction in code, nested bodies included."""
+    for ins in code:
+        yield ins
+        if ins[2] is not None:
+            yield from _walk(ins[2])
+
+
+class _State:
+    """Known register values by VM slot (see SLOTS) and the active page."""
+
+    def __init__(self, known=None, page=None):
+        self.known = {} if known is None else known
+        self.page = page
+
+    def copy(self):
+        return _State(dict(self.known), self.page)
+
+    def slot(self, r):
+        if r == 15:
+            return 15
+        return None if self.page is None else self.page * 16 + r
+
+    def get(self, r):
+        return self.known.get(self.slot(r))
+
+    def set(self, r, value):
+        slot = self.slot(r)
+        if slot is None:
+            self.kill({r}, False)
+        elif value is None:
+            self.known.pop(slot, None)
+        else:
+            self.known[slot] = value
+
+    def kill(self, regs, moves):
+        """Forget registers some code may write; moves says it may also change page."""
+        known = self.known
+        for r in regs:
+            if r == 15:
+                known.pop(15, None)
+            elif moves or self.page is None:
+                for p in range(8):
+                    known.pop(p * 16 + r, None)
+            else:
+                known.pop(self.page * 16 + r, None)
+        if moves:
+            self.page = None
+
+    def merge(self, other):
+        """Keep only what holds in both self and other."""
+        self.known = {k: v for k, v in self.known.items() if other.known.get(k) == v}
+        if self.page != other.page:
+            self.page = None
+
+
+class _Propagator:
+    def __init__(self, code, budget=0):
+        self.budget = budget  # most instructions one unrolled loop may become
+        # whatever any function does is what a CLL may do
+        self.fn_regs = set()
+        self.fn_moves = False
+        for op, args, body in _walk(code):
+            if op == "DEF":
+                regs, moves = self.effects(body, calls=False)
+                self.fn_regs |= regs
+                self.fn_moves |= moves
+
+    def effects(self, code, calls=True):
+        """(registers code may write, whether it may change page)."""
+        regs = set()
+        moves = False
+        for op, args, body in code:
+            if op == "DEF":
+                continue
+            if op in _WRITES or op in ("POP", "INH", "IND", "FOR", "VFR"):
+                regs.add(args[0])
+            elif op == "PG":
+                moves = True
+            elif op == "CLL" and calls:
+                regs |= self.fn_regs
+                moves |= self.fn_moves
+            if body is not None:
+                inner, inner_moves = self.effects(body, calls)
+                regs |= inner
+                moves |= inner_moves
+        return regs, moves
+
+    def block(self, code, st):
+        """Rewrite code entered with state st (updated in place); returns
+        the new list and whether it always ends the program."""
+        out = []
+        for i, ins in enumerate(code):
+            op, args, body = ins
+            if op == "EXO" or op == "ERR" or op == "]":
+                out.append(ins)
+                out.extend(code[i + 1:])
+                return out, True
+
+            if op == "PG":
+                st.page = args[0]
+            elif op == "CLZ" or op == "CLI" or op == "LD":
+                st.set(args[0], _loaded(ins))
+            elif op == "INC" or op == "DEC":
+                value = st.get(args[0])
+                if value is not None:
+                    value = (value + (1 if op == "INC" else -1)) & 0xFF
+                    ins = _load(args[0], value)
+                st.set(args[0], value)
+            elif op == "SET":
+                value = st.get(args[1])
+                if value is not None and value in (0, args[0]):
+                    ins = _load(args[0], value)
+                st.set(args[0], value)
+            elif op in _ARITH:
+                a, b = args
+                v1, v2 = st.get(a), st.get(b)
+                if v1 is not None and v2 is not None:
+                    value = _arith(op, v1, v2)
+                    ins = _load(a, value)
+                elif v2 is not None and (v2 == 0 and op in ("ADD", "SUB") or v2 == 1 and op in ("MUL", "DIV", "POW", "ROT")):
+                    continue  # a is left as it was
+                elif v1 == 0 and op in ("MUL", "DIV"):
+                    continue
+                elif v2 is not None and (v2 == 0 and op in ("MUL", "DIV", "ROT") or v2 >= 16 and op == "POW"):
+                    value = 0
+                    ins = _load(a, value)
+                elif v2 == 0 and op == "POW":
+                    value = 1
+                    ins = _load(a, value)
+                else:
+                    value = None
+                st.set(a, value)
+            elif op == "POP" or op == "INH" or op == "IND":
+                st.set(args[0], None)
+            elif op == "CLL":
+                st.kill(self.fn_regs, self.fn_moves)
+
+            elif op == "DEF":
+                # a function can be called from anywhere, so nothing is known on entry
+                ins = (op, args, self.block(body, _State())[0])
+            elif op == "IF":
+                v1, v2 = st.get(args[0]), st.get(args[2])
+                if v1 is not None and v2 is not None:
+                    if not _test(args[1], v1, v2):
+                        continue
+                    inner, halts = self.block(body, st)
+                    out.extend(inner)
+                    if halts:
+                        out.extend(code[i + 1:])
+                        return out, True
+                    continue
+                inside = st.copy()
+                body, halts = self.block(body, inside)
+                if not halts:
+                    st.merge(inside)
+                ins = (op, args, body)
+            elif op in _LOOPS:
+                if op == "FOR":
+                    count = args[1]
+                elif op == "REP" or op == "VFR":
+                    count = st.get(args[-1])
+                else:
+                    v1, v2 = st.get(args[0]), st.get(args[2])
+                    count = None if v1 is None or v2 is None else int(_test(args[1], v1, v2))
+                if count == 0:
+                    continue  # the body never runs
+                copies = self.unrolled(op, args, body, count) if self.budget and op != "WHL" else None
+                if copies is not None:
+                    inner, halts = self.block(copies, st)
+                    out.extend(inner)
+                    if halts:
+                        out.extend(code[i + 1:])
+                        return out, True
+                    continue
+                regs, moves = self.effects([ins])
+                st.kill(regs, moves)
+                ins = (op, args, self.block(body, st.copy())[0])
+            out.append(ins)
+        return out, False
+
+
+    def unrolled(self, op, args, body, count):
+        """Straight-line code for a loop with a known count, or None.
+
+        Only innermost loops are unrolled, fully when count copies of the
+        body fit the budget. A REP whose count register the body never
+        touches can also be unrolled partially, u copies per iteration:
+        LD c count//u; REP c [body * u]; LD c count; body * (count % u)."""
+        if count is None or any(ins[0] in _LOOPS or ins[0] == "DEF" for ins in _walk(body)):
+            return None
+        size = _size(body)
+        if op != "REP":
+            # FOR/VFR set their variable through the VM at every iteration
+            if count * (size + 1) > self.budget:
+                return None
+            return [ins for n in range(1, count + 1) for ins in [_load(args[0], n)] + body]
+        if count * size <= self.budget:
+            return body * count
+        per = self.budget // max(size, 1)
+        c = args[0]
+        # c holds count // per while the copies run, so they must neither
+        # touch it nor stop the program (or raise) halfway through
+        if per < 2 or any(op not in _PARTIAL or c in _registers(op, args)
+                          for op, args, _ in _walk(body)):
+            return None
+        return [_load(c, count // per), ("REP", args, body * per), _load(c, count)] + body * (count % per)
+
+
+def _size(code):
+    """Instructions in code, nested bodies included."""
+    return sum(1 for _ in _walk(code))
+
+
+def _registers(op, args):
+    """The register operands of one instruction."""
+    if op == "LD" or op == "FOR":
+        return args[:1]
+    if op in ("DEF", "UDF", "CLL"):
+        return ()  # function ids
+    return tuple(arg for kind, arg in zip(_OPERANDS.get(op, ()), args) if kind == "r")
+
+
+def propagate(code):
+    """Track known register values from the program start (every register
+    holds its own index, page 0) and fold what they decide: arithmetic,
+    INC/DEC and SET on known values become loads, no-op arithmetic is
+    dropped, IFs with a known outcome are inlined or removed and loops
+    known to run zero times are removed."""
+    return _Propagator(code).block(code, _start())[0]
+
+
+def unroll(code, budget=64):
+    """propagate, also unrolling innermost FOR loops, and REP/VFR loops with
+    a known count, into at most budget instructions each (see
+    _Propagator.unrolled). The copies are propagated through as well, so
+    each one sees its own value of the loop variable."""
+    return _Propagator(code, budget).block(code, _start())[0]
+
+
+def _start():
+    """The state every program starts in: each register holds its own
+    index and page 0 is active."""
+    start = _State({p * 16 + r: r for p in range(8) for r in range(15)}, 0)
+    start.known[15] = 15
+    return start
+
+
+# -------------------------------------------------------------
+# Dead code elimination
+# -------------------------------------------------------------
+def _superseded(code, i, top):
+    """Whether the DEF at code[i] is replaced (by a DEF or UDF of the same
+    id) or the program ends before anything after it could call it."""
+    fid = code[i][1][0]
+    for op, args, body in code[i + 1:]:
+        if (op == "DEF" or op == "UDF") and args[0] == fid:
+            return True
+        if op in ("EXO", "ERR", "]"):
+            return True
+        if op == "CLL" or (body is not None and any(ins[0] == "CLL" for ins in _walk(body))):
+            return False
+    return top
+
+
+def _eliminate(code, called, defined, top):
+    out = []
+    for i, ins in enumerate(code):
+        op, args, body = ins
+        if op == "]":
+            break  # the program halts here as it would at the end
+        if op == "EXO" or op == "ERR":
+            out.append(ins)
+            break
+        if op == "DEF":
+            if args[0] not in called or _superseded(code, i, top):
+                continue
+        elif op == "UDF" or op == "CLL":
+            if args[0] not in called or args[0] not in defined:
+                continue
+        elif (op == "IF" or op == "WHL") and args[0] == args[2]:
+            # a register compared with itself: = < > always hold, ! never does
+            if args[1] == 3:
+                continue
+            if op == "IF":
+                out.extend(_eliminate(body, called, defined, False))
+                if out and out[-1][0] in ("EXO", "ERR"):
+                    break
+                continue
+        elif op == "FOR" and args[1] == 0:
+            continue
+        if body is not None:
+            body = _eliminate(body, called, defined, False)
+            if not body and (op == "IF" or op == "REP"):
+                continue
+            if not body and op == "FOR":
+                ins = _load(args[0], args[1])  # the variable ends at the count
+            else:
+                ins = (op, args, body)
+        out.append(ins)
+    return out
+
+
+def eliminate(code):
+    """Remove code that cannot run or has no effect: everything after an
+    EXO, ERR or top-level ], DEFs nothing calls before they are replaced
+    or the program ends, CLL and UDF of ids never defined or called,
+    conditions comparing a register with itself, zero-count FORs and
+    empty IF/REP bodies."""
+    while True:
+        called = {args[0] for op, args, _ in _walk(code) if op == "CLL"}
+        defined = {args[0] for op, args, _ in _walk(code) if op == "DEF"}
+        smaller = _eliminate(code, called, defined, True)
+        if smaller == code:
+            return code
+        code = smaller
+
+
+PASSES = [propagate, eliminate, peephole]
+
+
+def optimizeCode(split, passes=None, unroll_budget=0):
+    """Run the optimizer passes over a splitCode token list.
+
+    With unroll_budget the default passes start with unroll instead of
+    propagate. Returns the optimized token list, or split itself when it
+    does not parse as whole instructions."""
+    try:
+        code = parseTokens(split)
+    except (_Unparsable, RecursionError):
+        return split
+    if passes is None:
+        passes = PASSES
+        if unroll_budget:
+            passes = [lambda code: unroll(code, unroll_budget)] + PASSES[1:]
+    for stage in passes:
+        code = stage(code)
+    return emitTokens(code)
@@ -0,0 +1,124 @@
+# =============================================================
+#   Per-instruction profiler for the VM (VM(..., profile=True))
+# =============================================================
+
+import json
+import time
+from collections import defaultdict
+from .smolbitCore import *
+
+# opcode classes, following the bit encoding's top-level groups
+OP_CLASSES = {}
+for _op in (OP_INC, OP_DEC, OP_CLZ, OP_CLI, OP_PUS, OP_POP):
+    OP_CLASSES[_op] = "manipulate"
+OP_CLASSES[OP_PAGE] = "page"
+for _op in (OP_ADD, OP_SUB, OP_MUL, OP_DIV, OP_SET, OP_LOAD, OP_POW, OP_ROT):
+    OP_CLASSES[_op] = "arithmetic"
+for _op in (OP_DPU, OP_DPD, OP_DPH, OP_DPI, OP_DPM):
+    OP_CLASSES[_op] = "display"
+for _op in (OP_IF, OP_REP, OP_DEF, OP_UDF, OP_CLL, OP_FOR, OP_VFR, OP_WHL):
+    OP_CLASSES[_op] = "block"
+for _op in (OP_END, OP_ENDIF, OP_NEXTREP, OP_NEXTFOR, OP_WEND, OP_RET):
+    OP_CLASSES[_op] = "block end"
+for _op in (OP_EXO, OP_ERR, OP_INH, OP_IND):
+    OP_CLASSES[_op] = "iocd"
+
+
+class Profiler:
+    """Counts every instruction a VM runs and the wall time until the next one.
+
+    Block and function figures are derived from those per-index numbers:
+    a block's time is the time spent on the instructions inside it (time in
+    functions it calls is counted under their DEF), a function's calls are
+    the number of times its body was entered."""
+
+    def __init__(self, vm):
+        self.vm = vm
+        self.counts = defaultdict(int)
+        self.times = defaultdict(float)
+        self.clock = time.perf_counter
+        self.last = None
+        self.since = 0.0
+
+    def start(self):
+        self.last = None
+        self.since = self.clock()
+
+    def fetch(self, pc, ins):
+        now = self.clock()
+        if self.last is not None:
+            self.times[self.last] += now - self.since
+        self.counts[pc] += 1
+        self.last = pc
+        self.since = now
+
+    def stop(self):
+        if self.last is not None:
+            self.times[self.last] += self.clock() - self.since
+            self.last = None
+
+    # ---------------------------------------------------------
+    # Reports
+    # ---------------------------------------------------------
+    def stats(self):
+        """Return the collected numbers as a dict, each table sorted by time."""
+        program = self.vm.program
+        if not program.done:
+            program.fill()
+        code, jumps = program.code, program.jumps
+
+        # prefix sums so a block's time is one subtraction
+        total = [0.0]
+        for pc in range(len(code)):
+            total.append(total[-1] + self.times.get(pc, 0.0))
+
+        ops = {}
+        for pc, n in self.counts.items():
+            op = code[pc][0]
+            row = ops.setdefault(op, {"op": OP_NAMES[op], "class": OP_CLASSES[op], "count": 0, "time": 0.0})
+            row["count"] += n
+            row["time"] += self.times.get(pc, 0.0)
+
+        blocks = []
+        functions = {}
+        for pc, (op, a, b, c) in enumerate(code):
+            if op not in BLOCK_OPS or jumps[pc] is None:
+                continue
+            end = jumps[pc]
+            if op == OP_DEF:
+                row = functions.setdefault(a, {"id": a, "calls": 0, "time": 0.0})
+                row["calls"] += self.counts.get(pc + 1, 0)
+                row["time"] += total[end] - total[pc + 1]
+            elif pc in self.counts:
+                blocks.append({"pc": pc, "type": OP_NAMES[op], "entries": self.counts[pc],
+                               "iterations": self.counts.get(end - 1, 0),
+                               "time": total[end] - total[pc]})
+
+        by_time = lambda row: -row["time"]
+        return {
+            "instructions": sum(self.counts.values()),
+            "time": total[-1],
+            "opcodes": sorted(ops.values(), key=by_time),
+            "blocks": sorted(blocks, key=by_time),
+            "functions": sorted(functions.values(), key=by_time),
+        }
+
+    def report(self, as_json=False):
+        """Format stats() as a text table, or as JSON."""
+        stats = self.stats()
+        if as_json:
+            return json.dumps(stats, indent=2)
+        lines = [f"{stats['instructions']} instructions in {stats['time'] * 1000:.3f} ms", "",
+                 f"{'opcode':<8}{'class':<12}{'count':>12}{'time (ms)':>14}"]
+        for row in stats["opcodes"]:
+            lines.append(f"{row['op']:<8}{row['class']:<12}{row['count']:>12}{row['time'] * 1000:>14.3f}")
+        if stats["blocks"]:
+            lines += ["", f"{'block':<20}{'entries':>12}{'iterations':>12}{'time (ms)':>14}"]
+            for row in stats["blocks"]:
+                name = f"{row['type']} @{row['pc']}"
+                lines.append(f"{name:<20}{row['entries']:>12}{row['iterations']:>12}{row['time'] * 1000:>14.3f}")
+        if stats["functions"]:
+            lines += ["", f"{'function':<20}{'calls':>12}{'time (ms)':>26}"]
+            for row in stats["functions"]:
+                lines.append(f"{'DEF ' + format(row['id'], 'x'):<20}{row['calls']:>12}{row['time'] * 1000:>26.3f}")
+        return "\n".join(lines)
@@ -0,0 +1,298 @@
+# =============================================================
+#   Python backend: decoded SmolBit -> Python AST -> code object
+# =============================================================
+# Registers become local variables of one generated function, blocks
+# become native while/for/if statements and every DEF becomes a nested
+# function, so a compiled program runs without any dispatch loop.
+#
+# When the active page is known at every instruction (always true for
+# programs that never use PGn inside a block or a function) each page's
+# registers are separate locals. Otherwise the program is compiled with
+# a runtime page offset and its registers live in one flat list.
+# Register f is always the single local `rf`.
+#
+# Every CLL is a Python call, so recursion is bounded by Python's
+# recursion limit: runPy raises it to make room for max_depth nested
+# calls, as VM allows, for the length of the run.
+
+import ast
+import builtins
+import sys
+from .smolbitCore import *
+
+MASK = 0xFFFFFFFF
+
+_COMPARE = (ast.Eq, ast.LtE, ast.GtE, ast.NotEq)
+
+
+class _Dynamic(Exception):
+    """The page is not statically known somewhere in the program."""
+
+
+def _static_pages(code):
+    """Return the set of pages used if the page is known at every instruction, else None."""
+    used = {0}
+
+    def walk(pc, page, in_def):
+        while pc < len(code):
+            op, a, b, c = code[pc]
+            pc += 1
+            if op == OP_PAGE:
+                if in_def:
+                    raise _Dynamic()
+                page = a
+                used.add(a)
+            elif op in BLOCK_OPS:
+                after, pc = walk(pc, page, in_def or op == OP_DEF)
+                if after != page and op != OP_DEF:
+                    raise _Dynamic()
+            elif OP_END <= op <= OP_RET:
+                return page, pc
+        return page, pc
+
+    try:
+        walk(0, 0, False)
+    except _Dynamic:
+        return None
+    return used
+
+
+def _name(id, store=False):
+    return ast.Name(id=id, ctx=ast.Store() if store else ast.Load())
+
+
+def _call(func, *args, **kwargs):
+    return ast.Call(func=func if isinstance(func, ast.AST) else _name(func), args=list(args),
+                    keywords=[ast.keyword(arg=k, value=v) for k, v in kwargs.items()])
+
+
+def _mask(expr, mask=MASK):
+    return ast.BinOp(left=expr, op=ast.BitAnd(), right=ast.Constant(mask))
+
+
+class _Builder:
+    def __init__(self, code, pages):
+        self.code = code
+        self.pages = pages  # set of static pages, or None for a runtime page
+        self.nfuncs = 0
+
+    # ---------------------------------------------------------
+    # Registers
+    # ---------------------------------------------------------
+    def reg(self, n, page, store=False):
+        if n == 15:
+            return _name("rf", store)
+        if self.pages is not None:
+            return _name(f"p{page}r{n}", store)
+        index = ast.BinOp(left=_name("pg"), op=ast.Add(), right=ast.Constant(n))
+        return ast.Subscript(value=_name("R"), slice=index, ctx=ast.Store() if store else ast.Load())
+
+    def assign(self, n, page, value):
+        return ast.Assign(targets=[self.reg(n, page, True)], value=value)
+
+    def fns(self, page):
+        return _name("fns" if self.pages is None else f"fns{page}")
+
+    # ---------------------------------------------------------
+    # Statements
+    # ---------------------------------------------------------
+    def block(self, pc, page):
+        """Translate records from pc up to the closing ]; returns (stmts, pc after ])."""
+        code = self.code
+        out = []
+        while pc < len(code):
+            op, a, b, c = code[pc]
+            pc += 1
+            r = lambda n: self.reg(n, page)
+
+            if op == OP_INC or op == OP_DEC:
+                step = ast.Add() if op == OP_INC else ast.Sub()
+                out.append(self.assign(a, page, _mask(ast.BinOp(left=r(a), op=step, right=ast.Constant(1)), 0xFF)))
+            elif op == OP_CLZ:
+                out.append(self.assign(a, page, ast.Constant(0)))
+            elif op == OP_CLI:
+                out.append(self.assign(a, page, ast.Constant(a)))
+            elif op == OP_PUS:
+                out.append(ast.Expr(_call(ast.Attribute(value=_name("stack"), attr="append", ctx=ast.Load()), r(a))))
+            elif op == OP_POP:
+                out.append(self.assign(a, page, _call(ast.Attribute(value=_name("stack"), attr="pop", ctx=ast.Load()))))
+
+            elif op == OP_PAGE:
+                if self.pages is None:
+                    out.append(ast.Assign(targets=[_name("pg", True)], value=ast.Constant(a * 16)))
+                page = a
+
+            elif op == OP_LOAD:
+                out.append(self.assign(a, page, ast.Constant(b)))
+            elif op == OP_SET:
+                out.append(self.assign(a, page, r(b)))
+            elif op in (OP_ADD, OP_SUB, OP_MUL):
+                binop = {OP_ADD: ast.Add, OP_SUB: ast.Sub, OP_MUL: ast.Mult}[op]()
+                out.append(self.assign(a, page, _mask(ast.BinOp(left=r(a), op=binop, right=r(b)))))
+            elif op == OP_DIV:
+                div = ast.BinOp(left=r(a), op=ast.FloorDiv(), right=r(b))
+                out.append(self.assign(a, page, ast.IfExp(test=r(b), body=div, orelse=ast.Constant(0))))
+            elif op == OP_POW:
+                power = _mask(ast.BinOp(left=r(a), op=ast.Pow(), right=r(b)))
+                test = ast.Compare(left=r(b), ops=[ast.Lt()], comparators=[ast.Constant(16)])
+                out.append(self.assign(a, page, ast.IfExp(test=test, body=power, orelse=ast.Constant(0))))
+            elif op == OP_ROT:
+                exponent = ast.BinOp(left=ast.Constant(1), op=ast.Div(), right=r(b))
+                root = _mask(_call("int", ast.BinOp(left=r(a), op=ast.Pow(), right=exponent)))
+                out.append(self.assign(a, page, ast.IfExp(test=r(b), body=root, orelse=ast.Constant(0))))
+
+            elif op == OP_DPU:
+                out.append(ast.Expr(_call("write", _call("chr", r(a)))))
+            elif op == OP_DPD:
+                out.append(ast.Expr(_call("write", _call("str", r(a)))))
+            elif op == OP_DPH:
+                digits = ast.Subscript(value=_call("hex", r(a)), slice=ast.Slice(lower=ast.Constant(2)), ctx=ast.Load())
+                out.append(ast.Expr(_call("write", _call(ast.Attribute(value=digits, attr="upper", ctx=ast.Load())))))
+            elif op == OP_DPI:
+                out.append(ast.Expr(_call("write", ast.Constant(chr(a)))))
+            elif op == OP_DPM:
+                if isinstance(a, bytes):
+                    # invalid UTF-8 fails when it is printed, as under VM
+                    decode = ast.Attribute(value=ast.Constant(a), attr="decode", ctx=ast.Load())
+                    text = ast.BinOp(left=_call(decode, ast.Constant("utf-8")), op=ast.Add(), right=ast.Constant("\n"))
+                else:
+                    text = ast.Constant(a + "\n")
+                out.append(ast.Expr(_call("write", text)))
+
+            elif op == OP_IF or op == OP_WHL:
+                test = ast.Compare(left=r(a), ops=[_COMPARE[b]()], comparators=[r(c)])
+                body, pc = self.block(pc, page)
+                node = ast.If if op == OP_IF else ast.While
+                out.append(node(test=test, body=body, orelse=[]))
+            elif op == OP_REP:
+                body, pc = self.block(pc, page)
+                out.append(ast.For(target=_name("_", True), iter=_call("range", r(a)), body=body, orelse=[]))
+            elif op == OP_FOR or op == OP_VFR:
+                count = ast.Constant(b) if op == OP_FOR else r(b)
+                stop = ast.BinOp(left=count, op=ast.Add(), right=ast.Constant(1))
+                body, pc = self.block(pc, page)
+                out.append(ast.For(target=self.reg(a, page, True), iter=_call("range", ast.Constant(1), stop),
+                                   body=body, orelse=[]))
+
+            elif op == OP_DEF:
+                start = pc
+                for p in sorted(self.pages) if self.pages is not None else (page,):
+                    body, pc = self.block(start, p)
+                    out.append(self.function(f"_f{self.nfuncs}", body))
+                    self.nfuncs += 1
+                    key = ast.Subscript(value=self.fns(p), slice=ast.Constant(a), ctx=ast.Store())
+                    out.append(ast.Assign(targets=[key], value=_name(out[-1].name)))
+            elif op == OP_UDF:
+                for p in sorted(self.pages) if self.pages is not None else (page,):
+                    pop = ast.Attribute(value=self.fns(p), attr="pop", ctx=ast.Load())
+                    out.append(ast.Expr(_call(pop, ast.Constant(a), ast.Constant(None))))
+            elif op == OP_CLL:
+                get = ast.Attribute(value=self.fns(page), attr="get", ctx=ast.Load())
+                out.append(ast.Assign(targets=[_name("_fn", True)], value=_call(get, ast.Constant(a))))
+                test = ast.Compare(left=_name("_fn"), ops=[ast.IsNot()], comparators=[ast.Constant(None)])
+                out.append(ast.If(test=test, body=[ast.Expr(_call("_fn"))], orelse=[]))
+
+            elif OP_END <= op <= OP_RET:
+                break
+
+            elif op == OP_EXO or op == OP_ERR:
+                out.append(ast.Expr(_call("exit", ast.Constant(op - OP_EXO))))
+            elif op == OP_INH or op == OP_IND:
+                prompt, base = ("hex> ", 16) if op == OP_INH else ("dec> ", 10)
+                value = _call("int", _call("input", ast.Constant(prompt)), ast.Constant(base))
+                out.append(self.assign(a, page, _mask(value)))
+
+        return out or [ast.Pass()], pc
+
+    def function(self, name, body, shared=True):
+        """Wrap statements into a function; shared functions (DEF bodies)
+        write the enclosing program's registers through nonlocal."""
+        func = ast.parse("def f(): pass").body[0]
+        func.name = name
+        if shared:
+            stores = sorted({node.id for stmt in body for node in ast.walk(stmt)
+                             if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Store)
+                             and not node.id.startswith("_")})
+            if stores:
+                body = [ast.Nonlocal(names=stores)] + body
+        func.body = body
+        return func
+
+    def module(self):
+        init = [ast.Assign(targets=[_name("rf", True)], value=ast.Constant(15)),
+                ast.Assign(targets=[_name("stack", True)], value=ast.List(elts=[], ctx=ast.Load()))]
+        if self.pages is None:
+            regs = ast.List(elts=[ast.Constant(n) for _ in range(8) for n in range(16)], ctx=ast.Load())
+            init.append(ast.Assign(targets=[_name("R", True)], value=regs))
+            init.append(ast.Assign(targets=[_name("pg", True)], value=ast.Constant(0)))
+            init.append(ast.Assign(targets=[_name("fns", True)], value=ast.Dict(keys=[], values=[])))
+        else:
+            for p in sorted(self.pages):
+                for n in range(15):
+                    init.append(ast.Assign(targets=[_name(f"p{p}r{n}", True)], value=ast.Constant(n)))
+                init.append(ast.Assign(targets=[_name(f"fns{p}", True)], value=ast.Dict(keys=[], values=[])))
+        body, _ = self.block(0, 0)
+        main = self.function("smolbit_main", init + body, shared=False)
+        return ast.fix_missing_locations(ast.Module(body=[main], type_ignores=[]))
+
+
+def toAst(code):
+    """Translate a decoded program (see decode) into a Python ast.Module.
+
+    The module defines smolbit_main(), which runs the program with write
+    (for output), input and exit looked up in the globals it is executed with."""
+    return _Builder(code, _static_pages(code)).module()
+
+
+def compilePy(bitcode: str, filename="<smolbit>"):
+    """Compile a '0'/'1' string or .smbt path to a Python code object."""
+    return compile(toAst(decode(load_bitcode(bitcode))), filename, "exec")
+
+
+def runPy(bitcode: str, namespace=None, output=None, max_depth=100000):
+    """Compile and run a SmolBit program as native Python code and return
+    its RunResult.
+
+    Output goes through an OutputSink like the VM's (output may be a sink
+    or a stream); namespace can override write, input or exit. EXO and
+    ERR end the run with status 0 and 1, as under VM.run. The registers
+    and stack are locals of the compiled code, so the result has None
+    for both.
+
+    Calls nest up to max_depth deep, as under VM: Python's recursion
+    limit is raised to allow it while the program runs (process-wide,
+    so other threads see it too), and going deeper raises
+    CallDepthExceeded. The count is not exact: Python calls made by
+    write or input use a little of the same room."""
+    sink = output if isinstance(output, OutputSink) else OutputSink(output)
+
+    def read(prompt=""):
+        sink.flush()
+        return input(prompt)
+
+    def stop(status):
+        raise ProgramExit(status)
+
+    scope = {"__builtins__": builtins, "write": sink.write, "input": read, "exit": stop}
+    if namespace:
+        scope.update(namespace)
+    exec(compilePy(bitcode), scope)
+    limit = sys.getrecursionlimit()
+    # the frames below this one, smolbit_main and some room for write and input
+    depth = 0
+    frame = sys._getframe()
+    while frame is not None:
+        depth += 1
+        frame = frame.f_back
+    sys.setrecursionlimit(max(limit, depth + max_depth + 64))
+    status = 0
+    try:
+        scope["smolbit_main"]()
+    except ProgramExit as e:
+        status = e.status
+    except RecursionError as e:
+        raise CallDepthExceeded("depth", max_depth) from e
+    finally:
+        sys.setrecursionlimit(limit)
+        sink.flush()
+    return RunResult(status, None, None)
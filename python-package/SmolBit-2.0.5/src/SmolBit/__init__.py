@@ -1,3 +1,11 @@
+__version__ = "2.0.5"
+
 from .smolbitCore import *
 from .SyntaxChecker import *
-from .Converter import *
\ No newline at end of file
+from .Converter import *
+from .Container import *
+from .Optimizer import *
+from .PyCompiler import *
+from .Profiler import *
+from .Cache import *
+from .Batch import *
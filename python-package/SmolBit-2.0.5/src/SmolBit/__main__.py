@@ -1,30 +1,111 @@
 from .smolbitCore import *
 from .Converter import *
+from .Container import *
+from .Optimizer import *
 from .SyntaxChecker import *
+from .PyCompiler import *
+from .Profiler import *
+from .Cache import *
+from .Batch import *
+import json
 import sys
 if __name__ == "__main__":
     helpmsg="""
 Commands 
-run [smbt file] | runs the compiled smbt file
-compile [smolbit file] [smbt path] | compiles the smolbit script to an ambt file
+run [smbt file] (nocache) | runs the compiled smbt file; with nocache, without the decode cache
+pyrun [smbt file] | translates the compiled smbt file to Python code and runs it
+profile [smbt file] (json) (nocache) | runs the compiled smbt file and reports instruction counts and timings
+compile [smolbit file] [smbt path] (stream|optimize|unroll|container|nocache) | compiles the smolbit script to an ambt file; with stream, in bounded memory and without the syntax check; with optimize, through the optimizer passes; with unroll, also unrolling small loops; with container, as a container with a header and block index; with nocache, without the compile cache
+pack [smbt file] [smbt path] | wraps a raw smbt file in a container
+batch [smbt file]... (inputs [input file]...) (json) (nocache) | runs every smbt file with each input file as stdin (or none) on all cores and reports their exit codes and output
+cache (clear) | shows where compiled and decoded programs are cached, or empties the cache
 """
     if(len(sys.argv)<2):
         print(helpmsg)
         exit()
     if sys.argv[1] == "run":
         bitcode = sys.argv[2]
-        vm = VM(bitcode)
-        vm.run()
+        vm = VM(bitcode, cache=None if "nocache" in sys.argv[3:] else defaultCache())
+        exit(vm.run().status)
+    elif sys.argv[1] == "pyrun":
+        exit(runPy(sys.argv[2]).status)
+    elif sys.argv[1] == "profile":
+        vm = VM(sys.argv[2], profile=True, cache=None if "nocache" in sys.argv[3:] else defaultCache())
+        try:
+            result = vm.run()
+        finally:
+            print(vm.profiler.report("json" in sys.argv[3:]), file=sys.stderr)
+        exit(result.status)
     elif(sys.argv[1] == "debugrun"):
         bitcode = sys.argv[2]
         vm = VM(bitcode, True)
-        vm.run(debug=True)
+        exit(vm.run(debug=True).status)
     elif sys.argv[1] == "compile":
         path = sys.argv[2]
         save = sys.argv[3]
+        if len(sys.argv) > 4 and sys.argv[4] == "stream":
+            if convertStream(path, save) is None:
+                exit(1)
+            exit()
         with open(path, "r") as file:
             bits = file.read()
-        checker(bits).check()
-        convert(bits, save)
+        options = dict(optimize="optimize" in sys.argv[4:], unroll_budget=64 if "unroll" in sys.argv[4:] else 0,
+                       container="container" in sys.argv[4:])
+        cache = None if "nocache" in sys.argv[4:] else defaultCache()
+        if cache is None:
+            checker(bits).check()
+            convert(bits, save, **options)
+        else:
+            data = cache.compile(bits, **options)
+            if data is not None:
+                with open(save, "wb") as file:
+                    file.write(data)
+    elif sys.argv[1] == "pack":
+        with open(sys.argv[2], "rb") as file:
+            data = file.read()
+        if isContainer(data):
+            print(f"{sys.argv[2]} is already a container")
+            exit(1)
+        with open(sys.argv[3], "wb") as file:
+            file.write(packContainer(data))
+    elif sys.argv[1] == "batch":
+        args = sys.argv[2:]
+        cache = defaultCache()
+        if args and args[-1] == "nocache":
+            args.pop()
+            cache = None
+        as_json = bool(args) and args[-1] == "json"
+        if as_json:
+            args.pop()
+        programs, names = args, None
+        if "inputs" in args:
+            programs, names = args[:args.index("inputs")], args[args.index("inputs") + 1:]
+        texts = None
+        if names is not None:
+            texts = []
+            for name in names:
+                with open(name) as file:
+                    texts.append(file.read())
+        results = runBatch(programs, texts, cache=cache)
+        for result in results:
+            result["program"] = programs[result["program"]]
+            result["input"] = None if names is None else names[result["input"]]
+        if as_json:
+            print(json.dumps(results, indent=2))
+        else:
+            for result in results:
+                source = result["program"] + ("" if result["input"] is None else " < " + result["input"])
+                error = "" if result["error"] is None else f" ({result['error']})"
+                print(f"== {source}: exit {result['status']}{error}")
+                print(result["output"], end="" if result["output"].endswith("\n") or not result["output"] else "\n")
+        exit(1 if any(result["status"] for result in results) else 0)
+    elif sys.argv[1] == "cache":
+        cache = defaultCache()
+        if cache is None:
+            print("the cache is turned off (SMOLBIT_CACHE is empty)")
+        elif len(sys.argv) > 2 and sys.argv[2] == "clear":
+            cache.clear()
+        else:
+            print(cache.path)
     elif sys.argv[1] == "help":
         print(helpmsg)
\ No newline at end of file
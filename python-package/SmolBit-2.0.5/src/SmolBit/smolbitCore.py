@@ -2,85 +2,774 @@
 #   VM for custom ISA (variable-length, bitstream-based)
 # =============================================================
 
+import asyncio
+import builtins
+import io
+import marshal
+import mmap
+import operator
+import os
+import sys
+import time
+import types
+
 class BitStream:
-    def __init__(self, bits: str, debug = False):
-        self.bits = bits.replace(" ","").replace("\n", "")
+    """Reads n-bit fields out of packed bytes.
+
+    Accepts a '0'/'1' string (packed once on construction) or any
+    bytes-like object, which is read in place through a memoryview.
+    length is the number of valid bits and defaults to all of them.
+    index holds the tables of the container it came from, if any."""
+
+    def __init__(self, bits, debug = False, length = None):
+        if isinstance(bits, str):
+            bits = bits.replace(" ","").replace("\n", "")
+            length = len(bits)
+            pad = -length % 8
+            bits = int(bits + "0" * pad or "0", 2).to_bytes((length + pad) // 8, "big")
+        self.data = memoryview(bits)
+        self.length = len(self.data) * 8 if length is None else length
         self.pos = 0
         self.debug = debug
+        self.index = None
 
-    def read(self, n):
-        """Read n bits as a string."""
-        if self.pos + n > len(self.bits):
+    @property
+    def bits(self):
+        """The stream as a '0'/'1' string (builds a full copy)."""
+        return format(int.from_bytes(self.data, "big"), f"0{len(self.data) * 8}b")[:self.length]
+
+    def _field(self, pos, n):
+        end = pos + n
+        if end > self.length:
             raise RuntimeError(f"Unexpected end of bitstream")
-        out = self.bits[self.pos:self.pos+n]
+        last = (end + 7) >> 3
+        chunk = int.from_bytes(self.data[pos >> 3:last], "big")
+        return (chunk >> ((last << 3) - end)) & ((1 << n) - 1)
+
+    def read_uint(self, n):
+        """Read n bits as an unsigned int."""
+        out = self._field(self.pos, n)
         self.pos += n
         if(self.debug):
-            print("r:", out)
+            print("r:", format(out, f"0{n}b"))
         return out
 
+    def read_bytes(self, n):
+        """Read n whole bytes (8n bits)."""
+        if self.pos & 7 or self.pos + 8 * n > self.length:
+            return bytes(self.read_uint(8) for _ in range(n))
+        start = self.pos >> 3
+        self.pos += 8 * n
+        return bytes(self.data[start:start + n])
+
+    def read(self, n):
+        """Read n bits as a string."""
+        return format(self.read_uint(n), f"0{n}b") if n else ""
+
     def peek(self, n):
-        if self.pos + n > len(self.bits):
-            raise RuntimeError("Unexpected end of bitstream")
-        return self.bits[self.pos:self.pos+n]
+        return format(self._field(self.pos, n), f"0{n}b") if n else ""
 
     def eof(self):
-        return self.pos >= len(self.bits)
+        return self.pos >= self.length
+
+
+# =============================================================
+#                     DECODER
+# =============================================================
+# The bitstream is decoded once into a flat list of instruction
+# records (op, a, b, c). Operands are already turned into ints and
+# immediates are resolved, so the VM never touches the bits again.
+# NOPs (and the unused manipulation modes 6/7) decode to nothing.
+
+(OP_INC, OP_DEC, OP_CLZ, OP_CLI, OP_PUS, OP_POP,
+ OP_PAGE,
+ OP_ADD, OP_SUB, OP_MUL, OP_DIV, OP_SET, OP_LOAD, OP_POW, OP_ROT,
+ OP_DPU, OP_DPD, OP_DPH, OP_DPI,
+ OP_IF, OP_REP, OP_DEF, OP_UDF, OP_CLL, OP_FOR, OP_VFR, OP_WHL, OP_DPM,
+ OP_END, OP_ENDIF, OP_NEXTREP, OP_NEXTFOR, OP_WEND, OP_RET,
+ OP_EXO, OP_ERR, OP_INH, OP_IND,
+ OP_RUN) = range(39)
+
+OP_NAMES = ("INC", "DEC", "CLZ", "CLI", "PUS", "POP",
+            "PG",
+            "ADD", "SUB", "MUL", "DIV", "SET", "LDI", "POW", "ROT",
+            "DPU", "DPD", "DPH", "DPI",
+            "IF", "REP", "DEF", "UDF", "CLL", "FOR", "VFR", "WHL", "DPM",
+            "]", "]IF", "]REP", "]FOR", "]WHL", "]DEF",
+            "EXO", "ERR", "INH", "IND",
+            "RUN")
+
+# opcodes that open a block closed by a matching OP_END
+BLOCK_OPS = frozenset((OP_IF, OP_REP, OP_DEF, OP_FOR, OP_VFR, OP_WHL))
+
+_ARITH_OPS = (OP_ADD, OP_SUB, OP_MUL, OP_DIV, OP_SET, OP_LOAD, OP_POW, OP_ROT)
+
+
+def iter_records(bs: BitStream):
+    """Yield the (op, a, b, c) instruction records of a BitStream in order."""
+    depth = 0
+    num = bs.read_uint
+
+    while not bs.eof():
+        if bs.length - bs.pos < 3:
+            break  # zero padding from binaryToBytes
+        op = num(3)
+
+        if op == 0b000:    # NOP
+            continue
+
+        elif op == 0b001:  # %mnip %addr
+            mnip = num(3)
+            addr = num(4)
+            if mnip < 6:
+                yield (OP_INC + mnip, addr, 0, 0)
+
+        elif op == 0b010:  # %int2 => page switch
+            yield (OP_PAGE, num(3), 0, 0)
+
+        elif op == 0b011:  # %armd %addr %addr
+            mode = num(3)
+            if mode == 5:
+                n = num(2)
+                addr = num(4)
+                yield (OP_LOAD, addr, num(8 * (n + 1)), 0)
+            else:
+                a1 = num(4)
+                a2 = num(4)
+                yield (_ARITH_OPS[mode], a1, a2, 0)
+
+        elif op == 0b100:  # %dpmd %addr / %byte
+            mode = num(2)
+            if mode < 3:
+                yield (OP_DPU + mode, num(4), 0, 0)
+            else:
+                yield (OP_DPI, num(8), 0, 0)
+
+        elif op == 0b101:  # %blok
+            blk_type = num(3)
+            if blk_type in (0, 6):    # IF / WHL %addr %cond %addr
+                a1 = num(4)
+                cond = num(2)
+                ins = (OP_WHL if blk_type else OP_IF, a1, cond, num(4))
+            elif blk_type == 5:       # FOR %addr %byte / VFR %addr %addr
+                mode = num(1)
+                addr = num(4)
+                if mode == 0:
+                    ins = (OP_FOR, addr, num(8), 0)
+                else:
+                    ins = (OP_VFR, addr, num(4), 0)
+            elif blk_type == 7:       # DPM %len %bytes
+                leng = num(16)
+                utf = bs.read_bytes(leng)
+                try:
+                    ins = (OP_DPM, utf.decode("utf-8"), 0, 0)
+                except UnicodeDecodeError:
+                    # kept as bytes, so that the error comes when it is printed
+                    ins = (OP_DPM, bytes(utf), 0, 0)
+            else:                     # REP / DEF / UDF / CLL %addr
+                ins = (OP_IF + blk_type, num(4), 0, 0)
+            if ins[0] in BLOCK_OPS:
+                depth += 1
+            yield ins
+
+        elif op == 0b110:  # block terminator
+            yield (OP_END, 0, 0, 0)
+            depth -= 1
+
+        elif op == 0b111:  # %iocd
+            iocd = num(2)
+            if iocd < 2:
+                yield (OP_EXO + iocd, 0, 0, 0)
+            else:
+                yield (OP_EXO + iocd, num(4), 0, 0)
+
+    if depth > 0:
+        raise RuntimeError("Unexpected end of bitstream")
+
+
+def decode(bs: BitStream):
+    """Decode a BitStream into a list of (op, a, b, c) instruction records."""
+    return list(iter_records(bs))
+
+
+# what each kind of block turns its closing ] into
+_BLOCK_ENDS = {OP_IF: OP_ENDIF, OP_REP: OP_NEXTREP, OP_DEF: OP_RET,
+               OP_FOR: OP_NEXTFOR, OP_VFR: OP_NEXTFOR, OP_WHL: OP_WEND}
+
+
+def _close(code, jumps, start, pc):
+    """Link the block opened at start with the ] at pc."""
+    jumps[start] = pc + 1
+    jumps[pc] = start
+    kind, a, b, c = code[start]
+    if kind == OP_WHL:
+        code[pc] = (OP_WEND, a, b, c)
+    else:
+        code[pc] = (_BLOCK_ENDS[kind], 0, 0, 0)
+
+
+# single-instruction loop bodies VM.closed_loop can compute in one step
+_CLOSED_BODIES = (OP_INC, OP_DEC, OP_ADD, OP_SUB, OP_MUL)
+
+# WHL a cond b [ X a ] shapes that count a towards b: < INC, ! INC, ! DEC, > DEC
+_CLOSED_WHILES = ((1, OP_INC), (3, OP_INC), (3, OP_DEC), (2, OP_DEC))
+
+
+def _closed_step(op, v, vs):
+    """One INC/DEC/ADD/SUB/MUL of v (by vs), masked like the VM does."""
+    if op == OP_INC or op == OP_DEC:
+        return (v + 1 if op == OP_INC else v - 1) & 0xFF
+    if op == OP_ADD:
+        return (v + vs) & 0xFFFFFFFF
+    return (v - vs if op == OP_SUB else v * vs) & 0xFFFFFFFF
+
+
+def _has_closed_form(opener, body):
+    """Whether a loop whose whole body is the one record body has a closed form."""
+    op, a, b, c = opener
+    if op == OP_REP or op == OP_FOR or op == OP_VFR:
+        return body[0] in _CLOSED_BODIES
+    if op == OP_WHL:
+        return body[1] == a and a != c and (b, body[0]) in _CLOSED_WHILES
+    return False
+
+
+def link(code):
+    """Build the block jump table for a decoded program.
+
+    For every block opener the table holds the index just past its closing ],
+    and for every ] the index of the opener it closes. Each matched ] is also
+    rewritten in place to say what it closes (a WHL's end carries the loop
+    condition); a stray ] at the top level stays OP_END and ends the program."""
+    jumps = [None] * len(code)
+    opened = []
+    for pc, ins in enumerate(code):
+        op = ins[0]
+        if op in BLOCK_OPS:
+            opened.append(pc)
+        elif op == OP_END and opened:
+            _close(code, jumps, opened.pop(), pc)
+    return jumps
+
+
+class Program:
+    """A decoded and linked program.
+
+    With lazy=True records are decoded from the BitStream only as execution
+    reaches them (see fill and end_of), so a large program starts running
+    without being decoded up front. A BitStream read from a container
+    brings its block table, so blocks are linked from it and end_of never
+    has to decode ahead to find a ].
+
+    closed maps the opener of every loop that VM.closed_loop can finish in
+    one step (a single INC/DEC/ADD/SUB/MUL body, or a WHL counting its
+    register towards another) to that body record."""
+
+    CHUNK = 4096  # records decoded per fill while running lazily
+
+    def __init__(self, bs: BitStream, lazy=False):
+        self.bs = bs
+        self.code = []
+        self.jumps = []
+        self.done = False
+        self.closed = {}
+        self.fast = None  # code with superinstructions, see fuse
+        self._records = iter_records(bs)
+        self._opened = []
+        self._index = bs.index
+        self._openers = None if bs.index is None else {end: start for start, end in bs.index.ends.items()}
+        if not lazy:
+            self.fill()
+
+    def fill(self, upto=None):
+        """Decode everything, or at least up to index upto.
+
+        Returns whether index upto now exists."""
+        code = self.code
+        jumps = self.jumps
+        opened = self._opened
+        openers = self._openers
+        stop = None if upto is None else max(upto, len(code)) + self.CHUNK
+        for ins in self._records:
+            pc = len(code)
+            code.append(ins)
+            jumps.append(None)
+            op = ins[0]
+            start = None
+            if openers is not None:
+                # linked from the container's block table
+                if op == OP_END and pc in openers:
+                    start = openers[pc]
+                    if code[start][0] not in BLOCK_OPS:
+                        raise ValueError("container block table does not match its bitstream")
+            elif op in BLOCK_OPS:
+                opened.append(pc)
+            elif op == OP_END and opened:
+                start = opened.pop()
+            if start is not None:
+                _close(code, jumps, start, pc)
+                if pc == start + 2 and _has_closed_form(code[start], code[start + 1]):
+                    self.closed[start] = code[start + 1]
+            if pc == stop:
+                return True
+        self.done = True
+        if self._index is not None and len(code) != self._index.records:
+            raise ValueError("container block table does not match its bitstream")
+        return upto is None or upto < len(code)
+
+    def fuse(self, counts=None, threshold=None):
+        """Build self.fast: a copy of code where each hot run (see SUPERINSTRUCTIONS) starts
+        with an OP_RUN superinstruction, so it takes a single dispatch.
+
+        A run is hot when it is expected to run at least threshold times;
+        counts (a Profiler's counts, by index) says how often, otherwise each
+        enclosing block multiplies the estimate by its trip count: a FOR's own
+        count, RUN_TRIPS for other loops and functions, 1 for IF."""
+        if not self.done:
+            self.fill()
+        if threshold is None:
+            threshold = RUN_THRESHOLD
+        code = self.code
+        fast = list(code)
+        weight = 1
+        outer = []
+        pc = 0
+        while pc < len(code):
+            op, a, b, c = code[pc]
+            if op in BLOCK_OPS:
+                outer.append(weight)
+                weight *= 1 if op == OP_IF else b if op == OP_FOR else RUN_TRIPS
+            elif OP_END <= op <= OP_RET:
+                weight = outer.pop() if outer else 1
+            elif _fusable(code[pc]):
+                start = pc
+                while pc + 1 < len(code) and _fusable(code[pc + 1]):
+                    pc += 1
+                hits = weight if counts is None else counts.get(start, 0)
+                # the record after a run is dispatched along with it, so a
+                # run needs one, and a single record gains nothing
+                if pc > start and pc + 1 < len(code) and hits >= threshold:
+                    fast[start] = (OP_RUN, _run_function(code[start:pc + 1]), pc + 1 - start, 0)
+            pc += 1
+        self.fast = fast
+
+    def dumps(self):
+        """The fully decoded and linked program as bytes, see loads."""
+        if not self.done:
+            self.fill()
+        return marshal.dumps((self.code, self.jumps, self.closed))
+
+    @classmethod
+    def loads(cls, bs, data):
+        """The Program of bs, restored from what dumps returned for it
+        instead of decoding bs again."""
+        program = cls(bs, lazy=True)
+        program.code, program.jumps, program.closed = marshal.loads(data)
+        program.done = True
+        program._records = iter(())
+        return program
+
+    def end_of(self, start):
+        """Index just past the ] closing the block opened at start, decoding up to it if needed."""
+        if self._index is not None and start in self._index.ends:
+            return self._index.ends[start] + 1
+        while self.jumps[start] is None:
+            if self.done:
+                raise RuntimeError("Unexpected end of bitstream")
+            self.fill(len(self.code))
+        return self.jumps[start]
+
+
+# =============================================================
+#                     SUPERINSTRUCTIONS
+# =============================================================
+# A run of straight-line records (register updates, PUS/POP and
+# output) runs as one generated Python function, called from an
+# (OP_RUN, function, length, 0) record that Program.fuse puts in place
+# of the run's first record. The VM dispatches the record ending the
+# run in the same step, so INC + IF, PUS + CLL or a loop body + its ]
+# cost one dispatch. A run never holds a block opener, ], CLL, PGn or
+# I/O code, and every jump lands just after one of those, so runs are
+# only entered at their first record and no index moves.
+#
+# Functions are compiled once per shape (opcodes and which operands
+# name the same register) and bound to a run's registers and constants
+# through their defaults, so a program with many similar runs pays for
+# compiling only a few.
+# The last RUN_CODES_LIMIT shapes are kept, so a long-lived process
+# loading program after program does not grow without bound.
+
+# a run is fused when it is expected to execute at least this often
+RUN_THRESHOLD = 16
+
+# estimated iterations of a REP/VFR/WHL and calls of a DEF
+RUN_TRIPS = 16
+
+# body lines per opcode: {0}/{1} are the slots of the a/b registers, {c} a constant
+_RUN_LINES = {
+    OP_INC: "regs[{0}] = (regs[{0}] + 1) & 0xFF",
+    OP_DEC: "regs[{0}] = (regs[{0}] - 1) & 0xFF",
+    OP_CLZ: "regs[{0}] = 0",
+    OP_CLI: "regs[{0}] = {c}",
+    OP_PUS: "stack.append(regs[{0}])",
+    OP_POP: "regs[{0}] = stack.pop()",
+    OP_ADD: "regs[{0}] = (regs[{0}] + regs[{1}]) & 0xFFFFFFFF",
+    OP_SUB: "regs[{0}] = (regs[{0}] - regs[{1}]) & 0xFFFFFFFF",
+    OP_MUL: "regs[{0}] = (regs[{0}] * regs[{1}]) & 0xFFFFFFFF",
+    OP_DIV: "regs[{0}] = regs[{0}] // regs[{1}] if regs[{1}] else 0",
+    OP_SET: "regs[{0}] = regs[{1}]",
+    OP_LOAD: "regs[{0}] = {c}",
+    OP_POW: "regs[{0}] = (regs[{0}] ** regs[{1}]) & 0xFFFFFFFF if regs[{1}] < 16 else 0",
+    OP_ROT: "regs[{0}] = int(regs[{0}] ** (1 / regs[{1}])) & 0xFFFFFFFF if regs[{1}] else 0",
+    OP_DPU: "write(chr(regs[{0}]))",
+    OP_DPD: "write(str(regs[{0}]))",
+    OP_DPH: "write(hex(regs[{0}])[2:].upper())",
+    OP_DPI: "write({c})",
+    OP_DPM: "write({c})",
+}
+
+
+def _fusable(record):
+    # a DPM of invalid UTF-8 holds bytes and is left to execute to fail on
+    return record[0] in _RUN_LINES and record[1].__class__ is not bytes
+
+# compiled run shapes kept for reuse, least recently used dropped first
+RUN_CODES_LIMIT = 1024
+_RUN_CODES = {}  # source -> code object, oldest first
+
+
+def _run_function(records):
+    """The function executing records, given as its regs, r, stack and write."""
+    head = []
+    body = []
+    defaults = []
+    slots = {}   # register -> name of the local holding its slot
+    text = None  # DPI/DPM output not yet written
+
+    def default(value):
+        defaults.append(value)
+        return f"d{len(defaults) - 1}"
+
+    def slot(n):
+        if n not in slots:
+            slots[n] = f"s{len(slots)}"
+            head.append(f"    {slots[n]} = r[{default(n)}]")
+        return slots[n]
+
+    for op, a, b, c in records:
+        if op == OP_DPI or op == OP_DPM:
+            text = (text or "") + (chr(a) if op == OP_DPI else a + "\n")
+            continue
+        if text is not None:
+            body.append(f"    write({default(text)})")
+            text = None
+        names = (slot(a), slot(b)) if op in _ARITH_OPS and op != OP_LOAD else (slot(a),)
+        constant = default(a) if op == OP_CLI else default(b) if op == OP_LOAD else None
+        body.append("    " + _RUN_LINES[op].format(*names, c=constant))
+    if text is not None:
+        body.append(f"    write({default(text)})")
+
+    params = "".join(f", d{i}" for i in range(len(defaults)))
+    source = "\n".join([f"def run(regs, r, stack, write{params}):"] + head + body)
+    code = _RUN_CODES.pop(source, None)
+    if code is None:
+        scope = {}
+        exec(source, scope)
+        code = scope["run"].__code__
+        if len(_RUN_CODES) >= RUN_CODES_LIMIT:
+            del _RUN_CODES[next(iter(_RUN_CODES))]
+    _RUN_CODES[source] = code
+    return types.FunctionType(code, globals(), "run", tuple(defaults))
+
+
+# =============================================================
+#                     OUTPUT
+# =============================================================
+
+class OutputSink:
+    """Collects program output and writes it out in batches.
+
+    stream can be any writable text or binary stream (binary streams get
+    UTF-8) or a function taking the text; None means whatever sys.stdout
+    is at flush time. Output is
+    written once limit characters are pending, and whenever flush() is
+    called: the VM flushes before reading input and when it stops."""
+
+    def __init__(self, stream=None, limit=8192):
+        self.stream = stream
+        self.limit = limit
+        self.parts = []
+        self.size = 0
+        self.binary = False
+
+    def write(self, text):
+        self.parts.append(text)
+        self.size += len(text)
+        if self.size >= self.limit:
+            self.flush()
+
+    def flush(self):
+        if not self.parts:
+            return
+        data = "".join(self.parts)
+        self.parts.clear()
+        self.size = 0
+        stream = sys.stdout if self.stream is None else self.stream
+        if not hasattr(stream, "write"):
+            stream(data)
+            return
+        if not self.binary:
+            try:
+                stream.write(data)
+            except TypeError:
+                self.binary = True
+        if self.binary:
+            stream.write(data.encode("utf-8"))
+        if hasattr(stream, "flush"):
+            stream.flush()
+
+
+# =============================================================
+#                     TRACING
+# =============================================================
+
+class _Fetch:
+    """Stands in for Program.code while debugging or profiling.
+
+    execute() reads code[pc] exactly once for every instruction it runs,
+    so hooks called from here see the whole execution, and a normal run
+    (which indexes the plain list) pays nothing for them."""
+
+    def __init__(self, code, hooks):
+        self.code = code
+        self.hooks = hooks
+
+    def __getitem__(self, pc):
+        ins = self.code[pc]
+        for hook in self.hooks:
+            hook(pc, ins)
+        return ins
+
+
+def _trace(pc, ins):
+    op, a, b, c = ins
+    print(f"{pc}: {OP_NAMES[op]} {a} {b} {c}")
 
 
 # =============================================================
 #                     THE VIRTUAL MACHINE
 # =============================================================
 
+# The register file is one flat list of 8 pages x 16 slots. Register f
+# has a single slot (page 0's) that every page maps to, so it is global
+# without any copying: SLOTS[page][addr] is the list index of a register.
+SLOTS = tuple(tuple(p * 16 + a if a != 15 else 15 for a in range(16)) for p in range(8))
+
+
+
+class RegisterPage:
+    """A live view of one page of a VM's registers, as VM.pages used to
+    hold them: page[addr] reads and writes the register itself, so
+    writing register f on any page writes it on all of them."""
+
+    def __init__(self, regs, slots):
+        self.regs = regs
+        self.slots = slots
+
+    def __getitem__(self, addr):
+        if isinstance(addr, slice):
+            return [self.regs[i] for i in self.slots[addr]]
+        return self.regs[self.slots[addr]]
+
+    def __setitem__(self, addr, value):
+        self.regs[self.slots[addr]] = value & 0xFFFFFFFF
+
+    def __len__(self):
+        return 16
+
+    def __iter__(self):
+        return (self.regs[i] for i in self.slots)
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __repr__(self):
+        return repr(list(self))
+
+# %cond 2-bit codes: = < > !  (< and > include equality)
+CONDS = (operator.eq, operator.le, operator.ge, operator.ne)
+
+
+def load_bitcode(bitcode: str, debug=False, mapped=False):
+    """Make a BitStream from a '0'/'1' string, packed bytes (as returned by
+    convert) or the path of a .smbt file.
+
+    Bytes and files may be a container (see Container) or a raw bitstream.
+
+    With mapped=True the file is mmap'ed read-only instead of read, so bits
+    are only paged in when they are decoded and the OS page cache is shared
+    by every process running the same file."""
+    if isinstance(bitcode, (bytes, bytearray, memoryview)):
+        return _unpack(bitcode, debug)
+    if(all(b in "01" for b in bitcode)):
+        return BitStream(bitcode, debug)
+    try:
+        with open(bitcode, "rb") as file:
+            if mapped and os.fstat(file.fileno()).st_size:
+                data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                data = file.read()
+    except:
+        raise ValueError("bitcode argument was improperly formatted")
+    return _unpack(data, debug)
+
+
+def _unpack(data, debug):
+    from .Container import isContainer, readContainer
+    if isContainer(data):
+        return readContainer(data, debug)
+    return BitStream(data, debug)
+
+
+# steps run between checks of the limits when none is close (see VM.refuel)
+CHECK_INTERVAL = 1 << 16
+
+
+class LimitExceeded(RuntimeError):
+    """A run went past one of the VM's limits: limit names it ("steps",
+    "depth", "stack" or "time") and value is what it was set to."""
+
+    def __init__(self, limit, value):
+        super().__init__(f"SmolBit {limit} limit of {value} exceeded")
+        self.limit = limit
+        self.value = value
+
+
+class CallDepthExceeded(LimitExceeded, RecursionError):
+    """Too many nested CLLs; also a RecursionError, as it always was."""
+
+
+class ProgramExit(Exception):
+    """Ends a run from inside the VM: EXO with status 0, ERR with status 1."""
+
+    def __init__(self, status):
+        super().__init__(status)
+        self.status = status
+
+
+class RunResult:
+    """How a run ended.
+
+    status is the exit code (0 when the program ends or runs EXO, 1 for
+    ERR or an error), error the exception that stopped it, if any, output
+    what it printed when that was captured (None otherwise), registers
+    a snapshot of the final registers (see VM.registers) and stack the
+    final stack."""
+
+    def __init__(self, status, registers, stack, output=None, error=None):
+        self.status = status
+        self.registers = registers
+        self.stack = stack
+        self.output = output
+        self.error = error
+
+    def __repr__(self):
+        return f"RunResult(status={self.status!r}, error={self.error!r}, output={self.output!r})"
+
+
 class VM:
-    def __init__(self, bitcode: str, debug=False):
-        if(all(b in "01" for b in bitcode)):
-            self.code = BitStream(bitcode, debug)
+    def __init__(self, bitcode: str, debug=False, max_depth=100000, mapped=False, output=None,
+                 profile=False, fuse=True, cache=None, input=None, max_steps=None, max_stack=None,
+                 timeout=None):
+        if isinstance(bitcode, Program):
+            # already decoded, e.g. shared by the runs of a batch
+            self.code = bitcode.bs
+            self.program = bitcode
+        elif cache is not None and not mapped:
+            # a Cache (see Cache.py) keeps the decoded program between runs
+            self.code = load_bitcode(bitcode, debug)
+            self.program = cache.program(self.code)
         else:
-            try:
-                with open(bitcode, "rb") as file:
-                    self.code = BitStream(''.join(format(byte, '08b') for byte in file.read()), debug)
-            except:
-                raise ValueError("bitcode argument was improperly formatted")
-        # 4 pages × 16 addresses × 16-bit values
-        self.pages = [[i for i in range(16)] for _ in range(8)]
-        self.page = 0  # current page (0–3)
-
-        # function table {id: bitstring}
+            # a mapped program is also decoded lazily, so startup does not depend on its size
+            self.code = load_bitcode(bitcode, debug, mapped)
+            self.program = Program(self.code, lazy=mapped)
+
+        # superinstructions for hot runs (see Program.fuse); a lazy program
+        # is never fully decoded up front and profiling counts every record
+        self.fuse = fuse and not mapped and not profile
+        if self.fuse and self.program.fast is None:
+            self.program.fuse()
+
+        # 8 pages × 16 addresses × 32-bit values, see SLOTS
+        self.regs = [a for _ in range(8) for a in range(16)]
+        self.page = 0  # current page (0–7)
+
+        # function table {id: index of the first body instruction}
         self.functions = {}
 
         self.stack = []
 
+        # DPU/DPD/DPH/DPI/DPM go through a buffered sink (unbuffered when debugging)
+        if isinstance(output, OutputSink):
+            self.output = output
+        else:
+            self.output = OutputSink(output, 0 if debug else 8192)
+
+        # INH/IND call input(prompt) for a line of text
+        self.input = input or builtins.input
+
+        # loop and call frames are kept on an explicit stack, so only
+        # max_depth (nested CLLs) limits recursion, not Python's own limit
+        self.frames = []
+        self.max_depth = max_depth
+
+        # optional limits for untrusted programs, see refuel
+        self.max_steps = max_steps
+        self.max_stack = max_stack
+        self.timeout = timeout
+        self.deadline = None
+        self.steps = 0
+        self.fuel = 0
+
+        # set by run_async: steps between turns given back to the event loop
+        self.interval = None
+        self.paused = 0  # self.steps at the last turn
+
+        # per-instruction counts and timings, see Profiler
+        self.profiler = None
+        if profile:
+            from .Profiler import Profiler
+            self.profiler = Profiler(self)
+
     # ---------------------------------------------------------
     # Helpers
     # ---------------------------------------------------------
-    def read_int(self, bs):
-        return int(bs, 2)
+    @property
+    def pages(self):
+        """The registers as 8 pages of 16, each a RegisterPage writing
+        through to self.regs: vm.pages[p][r] = x sets a register."""
+        return [RegisterPage(self.regs, slots) for slots in SLOTS]
+
+    @pages.setter
+    def pages(self, pages):
+        for view, values in zip(self.pages, pages):
+            for addr, value in enumerate(values):
+                view[addr] = value
+
+    def registers(self):
+        """Snapshot of the registers as 8 lists of 16, register f on every page."""
+        return [[self.regs[i] for i in slots] for slots in SLOTS]
 
     def get(self, addr):
-        return self.pages[self.page][addr]
+        return self.regs[SLOTS[self.page][addr]]
 
     def set(self, addr, value):
-        self.pages[self.page][addr] = value & 0xFFFFFFFF
-        for p in range(8):
-            self.pages[p][15] = self.pages[self.page][15]
-
-    # ---------------------------------------------------------
-    # Display
-    # ---------------------------------------------------------
-    def display(self, value, mode):
-        if mode == 0:   # utf-8 char
-            print(chr(value), end='')
-        elif mode == 1:  # decimal
-            print(value, end="")
-        elif mode == 2:  # hex
-            print(hex(value)[2:].upper(), end="")
-        elif mode == 3:  # utf-8 char (immediate)
-            print(chr(value), end="")
+        self.regs[SLOTS[self.page][addr]] = value & 0xFFFFFFFF
 
     # ---------------------------------------------------------
     # Arithmetic modes
     # ---------------------------------------------------------
-    def arithmetic(self, mode, a1, a2, bs):
+    def arithmetic(self, mode, a1, a2):
         v1 = self.get(a1)
         v2 = self.get(a2)
 
@@ -89,11 +778,6 @@ class VM:
         elif mode == 2: res = v1 * v2
         elif mode == 3: res = 0 if v2 == 0 else v1 // v2
         elif mode == 4: res = v2
-        elif mode == 5:
-            if a2 == 0: res = self.read_int(bs.read(8))
-            elif a2 == 1: res = self.read_int(bs.read(16))
-            elif a2 == 2: res = self.read_int(bs.read(24))
-            elif a2 == 3: res = self.read_int(bs.read(32))
         elif mode == 6: res = (v1 ** v2) if v2 < 16 else 0
         elif mode == 7: res = int(v1 ** (1 / v2)) if v2 != 0 else 0
         else: res = v1
@@ -101,286 +785,548 @@ class VM:
         self.set(a1, res)
 
     # ---------------------------------------------------------
-    # Manipulations
+    # EXECUTION ENGINE
     # ---------------------------------------------------------
-    def manipulate(self, mode, addr):
-        v = self.get(addr)
-        if mode == 0: v = (v + 1) & 0xFF
-        elif mode == 1: v = (v - 1) & 0xFF
-        elif mode == 2: v = 0
-        elif mode == 3: v = addr  # init value = address index
-        elif mode == 4: v = v; self.stack.append(v)
-        elif mode == 5: v = self.stack.pop()
-        self.set(addr, v)
+    def run(self, bs=None, debug=False):
+        """Run the decoded program, or decode and run another BitStream,
+        and return its RunResult.
 
-    # ---------------------------------------------------------
-    # Condition evaluation
-    # ---------------------------------------------------------
-    def cond(self, mode, a1, a2):
-        v1 = self.get(a1)
-        v2 = self.get(a2)
+        EXO and ERR end the run with status 0 and 1 instead of exiting the
+        process; any other error in the program is raised."""
+        if bs is not None:
+            self.program = Program(bs)
+            if self.fuse:
+                self.program.fuse()
+        self.interval = None
+        self.start()
+        status = 0
+        try:
+            for _ in self.execute(0, debug):
+                pass  # only yields under run_async
+        except ProgramExit as e:
+            status = e.status
+        finally:
+            self.stop()
+        return RunResult(status, self.registers(), list(self.stack))
 
-        if mode == 0: return v1 == v2
-        if mode == 1: return v1 <= v2
-        if mode == 2: return v1 >= v2
-        if mode == 3: return v1 != v2
-        return False
+    async def run_async(self, input=None, output=None, interval=CHECK_INTERVAL, debug=False):
+        """Run the decoded program as a coroutine and return its RunResult,
+        giving other tasks a turn every interval steps (see refuel).
 
-    # ---------------------------------------------------------
-    # EXECUTION ENGINE
-    # ---------------------------------------------------------
-    def run(self, bs=None, debug=False):
-        """Run starting at current code position or from a BitStream."""
-        if bs is None:
-            bs = self.code
-
-        while not bs.eof():
-            op = bs.read(3)
-            if(debug):
-                print('tlo')
-
-            # -------------------------------------------------
-            # 000 NOP
-            # -------------------------------------------------
-            if op == "000":
+        input is an async function taking a prompt and returning a line;
+        by default the VM's input function runs in a thread. output is an
+        async function taking text, awaited with what the program printed
+        at every turn and at the end; by default output goes where run
+        sends it. A timeout counts time spent waiting for either."""
+        pending = []
+        sink = self.output
+        if output is not None:
+            self.output = OutputSink(pending.append, sink.limit)
+        self.interval = interval
+        self.start()
+        run = self.execute(0, debug)
+        status = 0
+        line = None
+        try:
+            while True:
+                try:
+                    prompt = run.send(line)
+                except StopIteration:
+                    break
+                self.output.flush()
+                if pending:
+                    text = "".join(pending)
+                    pending.clear()
+                    await output(text)
+                if prompt is None:
+                    line = None
+                    await asyncio.sleep(0)
+                elif input is not None:
+                    line = await input(prompt)
+                else:
+                    line = await asyncio.get_running_loop().run_in_executor(None, self.input, prompt)
+        except ProgramExit as e:
+            status = e.status
+        finally:
+            run.close()
+            self.stop()
+            self.output = sink
+            self.interval = None
+            if pending:
+                await output("".join(pending))
+        return RunResult(status, self.registers(), list(self.stack))
+
+    def start(self):
+        """Reset the per-run state before execute."""
+        self.frames.clear()
+        self.steps = self.fuel = self.paused = 0
+        self.deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        if self.profiler is not None:
+            self.profiler.start()
+
+    def stop(self):
+        """Finish a run: stop profiling and write out pending output."""
+        if self.profiler is not None:
+            self.profiler.stop()
+        self.output.flush()
+
+    def execute(self, pc=0, debug=False):
+        """Execute records from pc until the program ends.
+
+        Blocks and function calls never recurse into Python: entering a loop
+        or a CLL pushes a frame onto self.frames and its closing ] pops it.
+        A loop frame is [counter, trips left] for REP and [i, paid, addr, count]
+        for FOR/VFR, a call frame is the index to return to.
+
+        Steps are counted down in fuel, a loop iteration or call costing the
+        length of its block. REP/FOR/VFR pay for their iterations up front
+        (see ration), WHL each time its ] is reached, CLL as it enters the
+        function, and closed forms for the iterations they stand for; code
+        outside loops and functions pays for the records it has passed at
+        each block and at the end. When fuel runs out, and when the program
+        ends, refuel checks the limits.
+
+        A generator: under run_async (self.interval set) it yields None to
+        give other tasks a turn (see refuel), which can come at any loop
+        iteration or function call, and at INH/IND it yields the
+        prompt and is sent the line read; otherwise it never yields.
+
+        With debug=True every instruction is printed before it runs."""
+        program = self.program
+        code = program.code
+        hooks = ([_trace] if debug else []) + ([self.profiler.fetch] if self.profiler else [])
+        if hooks:
+            code = _Fetch(code, hooks)
+        elif program.fast is not None:
+            code = program.fast
+        jumps = program.jumps
+        frames = self.frames
+        functions = self.functions
+        stack = self.stack
+        write = self.output.write
+        regs = self.regs
+        r = SLOTS[self.page]  # register -> regs index on the current page
+        conds = CONDS
+        # loops finished in one step; off while tracing so every iteration shows
+        closed = {} if hooks else program.closed
+        depth = 0
+        pausing = self.interval is not None
+        # how far top-level code has been paid for (see below)
+        mark = pc
+        status = None
+        fuel = yield from self.refuel(0)
+
+        while True:
+            try:
+                op, a, b, c = code[pc]
+            except IndexError:
+                if program.fill(pc):
+                    continue
+                break
+
+            if op == OP_RUN:
+                # a superinstruction: the run, then the record ending it
+                a(regs, r, stack, write)
+                pc += b
+                op, a, b, c = code[pc]
+
+            # most frequent instructions first
+            if op == OP_INC:
+                a = r[a]
+                regs[a] = (regs[a] + 1) & 0xFF
+
+            elif op == OP_ADD:
+                a = r[a]
+                regs[a] = (regs[a] + regs[r[b]]) & 0xFFFFFFFF
+
+            elif op == OP_IF or op == OP_WHL:
+                # code outside loops and functions runs once, so it is
+                # paid for by how far it has got, at each block it reaches
+                if not frames and pc > mark:
+                    fuel -= pc - mark
+                    mark = pc
+                    if fuel < 0:
+                        fuel = yield from self.refuel(fuel)
+                if not conds[b](regs[r[a]], regs[r[c]]):
+                    pc = jumps[pc] or program.end_of(pc)
+                    continue
+                if pc in closed:
+                    trips = self.closed_while(a, b, c, closed[pc], r)
+                    if trips:
+                        pc = jumps[pc]
+                        fuel -= 2 * trips
+                        if fuel < 0:
+                            fuel = yield from self.refuel(fuel)
+                        continue
+
+            elif op == OP_ENDIF:
+                pass
+
+            elif op == OP_NEXTFOR:
+                frame = frames[-1]
+                if frame[0] < frame[1]:
+                    frame[0] += 1
+                    regs[r[frame[2]]] = frame[0]
+                    pc = jumps[pc] + 1
+                    continue
+                if frame[1] < frame[3]:
+                    # the iterations paid for so far are done, pay for more
+                    trips, fuel = yield from self.ration(fuel, frame[3] - frame[1], pc - jumps[pc])
+                    frame[1] += trips
+                    continue
+                frames.pop()
+
+            elif op == OP_WEND:
+                start = jumps[pc]
+                fuel -= pc - start
+                if fuel < 0:
+                    fuel = yield from self.refuel(fuel)
+                if conds[b](regs[r[a]], regs[r[c]]):
+                    pc = start + 1
+                    continue
+
+            elif op == OP_LOAD:
+                regs[r[a]] = b
+
+            elif op == OP_SET:
+                regs[r[a]] = regs[r[b]]
+
+            elif op == OP_SUB:
+                a = r[a]
+                regs[a] = (regs[a] - regs[r[b]]) & 0xFFFFFFFF
+
+            elif op == OP_DEC:
+                a = r[a]
+                regs[a] = (regs[a] - 1) & 0xFF
+
+            elif op == OP_NEXTREP:
+                frame = frames[-1]
+                frame[0] -= 1
+                if frame[0]:
+                    pc = jumps[pc] + 1
+                    continue
+                if frame[1]:
+                    trips, fuel = yield from self.ration(fuel, frame[1], pc - jumps[pc])
+                    frame[0] = trips
+                    frame[1] -= trips
+                    pc = jumps[pc] + 1
+                    continue
+                frames.pop()
+
+            elif op == OP_CLL:
+                if not frames and pc > mark:
+                    fuel -= pc - mark
+                    mark = pc
+                    if fuel < 0:
+                        fuel = yield from self.refuel(fuel)
+                if a in functions:
+                    if depth >= self.max_depth:
+                        raise CallDepthExceeded("depth", self.max_depth)
+                    depth += 1
+                    frames.append(pc + 1)
+                    pc = functions[a]
+                    # the body is paid for on entry, so that recursion
+                    # which never returns still runs out of fuel
+                    fuel -= (jumps[pc - 1] or program.end_of(pc - 1)) - pc
+                    if fuel < 0:
+                        fuel = yield from self.refuel(fuel)
+                    continue
+
+            elif op == OP_RET:
+                depth -= 1
+                pc = frames.pop()
                 continue
 
-            # -------------------------------------------------
-            # 001 %mnip %addr
-            # -------------------------------------------------
-            elif op == "001":
-                mnip = self.read_int(bs.read(3))
-                addr = self.read_int(bs.read(4))
-                self.manipulate(mnip, addr)
-
-            # -------------------------------------------------
-            # 010 %int2 => page switch
-            # -------------------------------------------------
-            elif op == "010":
-                self.page = self.read_int(bs.read(3))
-
-            # -------------------------------------------------
-            # 011 %armd %addr %addr
-            # -------------------------------------------------
-            elif op == "011":
-                mode = self.read_int(bs.read(3))
-                if(mode == 5):
-                    a2 = self.read_int(bs.read(2))
-                    a1 = self.read_int(bs.read(4))
-                else:
-                    a1 = self.read_int(bs.read(4))
-                    a2 = self.read_int(bs.read(4))
-                self.arithmetic(mode, a1, a2, bs)
-
-            # -------------------------------------------------
-            # 100 %addr %dpmd
-            # -------------------------------------------------
-            elif op == "100":
-                mode = self.read_int(bs.read(2))
-                if(mode < 3):
-                    addr = self.read_int(bs.read(4))
-                    self.display(self.get(addr), mode)
-                else:
-                    value = self.read_int(bs.read(8))
-                    self.display(value,mode)
-
-            # -------------------------------------------------
-            # 101 %blok
-            # -------------------------------------------------
-            elif op == "101":
-                self.handle_block(bs, debug)
-
-            # -------------------------------------------------
-            # 110 block terminator
-            # -------------------------------------------------
-            elif op == "110":
-                return  # return to caller inside a block
-
-            # -------------------------------------------------
-            # 111 %iocd
-            # -------------------------------------------------
-            elif op == "111":
-                self.handle_iocd(bs)
+            elif op == OP_MUL:
+                a = r[a]
+                regs[a] = (regs[a] * regs[r[b]]) & 0xFFFFFFFF
 
-    # ---------------------------------------------------------
-    # Handle I/O codes
-    # ---------------------------------------------------------
-    def handle_iocd(self, bs):
-        code = self.read_int(bs.read(2))
+            elif op == OP_CLZ:
+                regs[r[a]] = 0
 
-        if code == 0:  # exit no error
-            exit(0)
+            elif op == OP_PAGE:
+                self.page = a
+                r = SLOTS[a]
 
-        elif code == 1:  # exit error
-            exit(1)
+            elif op == OP_REP:
+                if not frames and pc > mark:
+                    fuel -= pc - mark
+                    mark = pc
+                    if fuel < 0:
+                        fuel = yield from self.refuel(fuel)
+                count = regs[r[a]]
+                if count < 1:
+                    pc = jumps[pc] or program.end_of(pc)
+                    continue
+                if pc in closed:
+                    self.closed_loop(op, a, count, closed[pc], r)
+                    pc = jumps[pc]
+                    fuel -= 2 * count
+                    if fuel < 0:
+                        fuel = yield from self.refuel(fuel)
+                    continue
+                trips, fuel = yield from self.ration(fuel, count, (jumps[pc] or program.end_of(pc)) - 1 - pc)
+                frames.append([trips, count - trips])
 
-        elif code == 2:  # await hex -> store in addr
-            addr = self.read_int(bs.read(4))
-            val = int(input("hex> "), 16)
-            self.set(addr, val)
+            elif op == OP_FOR or op == OP_VFR:
+                if not frames and pc > mark:
+                    fuel -= pc - mark
+                    mark = pc
+                    if fuel < 0:
+                        fuel = yield from self.refuel(fuel)
+                count = b if op == OP_FOR else regs[r[b]]
+                if count < 1:
+                    pc = jumps[pc] or program.end_of(pc)
+                    continue
+                if pc in closed:
+                    self.closed_loop(op, a, count, closed[pc], r)
+                    pc = jumps[pc]
+                    fuel -= 2 * count
+                    if fuel < 0:
+                        fuel = yield from self.refuel(fuel)
+                    continue
+                trips, fuel = yield from self.ration(fuel, count, (jumps[pc] or program.end_of(pc)) - 1 - pc)
+                regs[r[a]] = 1
+                frames.append([1, trips, a, count])
 
-        elif code == 3:  # await binary -> store in addr
-            addr = self.read_int(bs.read(4))
-            val = int(input("dec> "), 10)
-            self.set(addr, val)
+            elif op == OP_PUS:
+                stack.append(regs[r[a]])
+
+            elif op == OP_POP:
+                regs[r[a]] = stack.pop()
+
+            elif op == OP_CLI:
+                regs[r[a]] = a
+
+            elif op <= OP_ROT:  # DIV, POW, ROT
+                self.arithmetic(op - OP_ADD, a, b)
+
+            elif op == OP_DPD:
+                write(str(regs[r[a]]))
+
+            elif op == OP_DPU:
+                write(chr(regs[r[a]]))
+
+            elif op == OP_DPI:
+                write(chr(a))
+
+            elif op == OP_DPH:
+                write(hex(regs[r[a]])[2:].upper())
+
+            elif op == OP_DPM:
+                if a.__class__ is bytes:
+                    a = a.decode("utf-8")  # raises: invalid UTF-8, see iter_records
+                write(a + "\n")
+
+            elif op == OP_DEF:
+                functions[a] = pc + 1
+                pc = jumps[pc] or program.end_of(pc)
+                continue
+
+            elif op == OP_UDF:
+                functions.pop(a, None)
+
+            elif op == OP_END:
+                break  # a stray ] at the top level ends the program
+
+            elif op == OP_EXO or op == OP_ERR:
+                status = op - OP_EXO
+                break
+
+            elif pausing and (op == OP_INH or op == OP_IND):
+                self.output.flush()
+                line = yield "hex> " if op == OP_INH else "dec> "
+                regs[r[a]] = int(line, 16 if op == OP_INH else 10) & 0xFFFFFFFF
+
+            else:
+                self.handle_iocd(op, a)
+            pc += 1
+
+        # the limits hold for the whole run, not only up to the last check
+        if not frames and pc > mark:
+            fuel -= pc - mark
+        yield from self.refuel(fuel)
+        if status is not None:
+            raise ProgramExit(status)
+
+    def refuel(self, fuel):
+        """Count the steps run on the fuel handed out last time (fuel is
+        what is left of it, less than 0 once overspent), check the limits
+        and hand out fuel up to the next check.
+
+        Raises LimitExceeded once max_steps steps have run, the stack holds
+        more than max_stack values or timeout seconds have passed since the
+        run started. Checks come at least every CHECK_INTERVAL steps and as
+        soon as a step or stack limit could be reached, at the places fuel
+        is charged (see execute) and at the end of the run. Between two
+        checks a run can overshoot a step or stack limit by one loop body,
+        one function body or the code outside them between two blocks.
+
+        A generator, so that under run_async it can yield a turn to the
+        event loop once interval steps have run since the last one."""
+        self.steps += self.fuel - fuel
+        fuel = CHECK_INTERVAL
+        if self.max_steps is not None:
+            if self.steps > self.max_steps:
+                raise LimitExceeded("steps", self.max_steps)
+            fuel = min(fuel, self.max_steps - self.steps)
+        if self.max_stack is not None:
+            if len(self.stack) > self.max_stack:
+                raise LimitExceeded("stack", self.max_stack)
+            fuel = min(fuel, self.max_stack - len(self.stack))
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            raise LimitExceeded("time", self.timeout)
+        if self.interval is not None:
+            if self.steps - self.paused >= self.interval:
+                self.paused = self.steps
+                yield
+            fuel = min(fuel, self.interval)
+        self.fuel = fuel
+        return fuel
+
+    def ration(self, fuel, trips, size):
+        """Pay for up to trips iterations of a loop size records long out of
+        fuel, refueling first if it cannot cover one.
+
+        Returns how many were paid for (at least one) and the fuel left, so
+        a long loop is stopped for a check every CHECK_INTERVAL steps.
+        A generator like refuel."""
+        if fuel < size:
+            fuel = yield from self.refuel(fuel)
+        trips = min(trips, fuel // size) or 1
+        return trips, fuel - trips * size
 
     # ---------------------------------------------------------
-    # BLOCK PROCESSING (IF, REPEAT, FOR, WHILE, FUNCTIONS)
+    # Closed-form loops (see Program.closed)
     # ---------------------------------------------------------
-    def collect_block(self, bs, debug):
-        """Collect raw bits until the ending 110 marker."""
-        chunk = ""
-        depth = 1
-        while True:
-            op = bs.read(3)
-            if(debug):
-                print(f"{depth}lo")
-            chunk += op
-            if op == "101":  # nested block
-                # add its type and keep nesting
-                blk_type = bs.read(3)
-                if(blk_type == "000" or blk_type == "110"):
-                    blk_type += bs.read(10)
-                elif(blk_type == "100" or blk_type == "011"):
-                    blk_type += bs.read(4)
-                    depth -= 1
-                elif(blk_type == "101"):
-                    mode = bs.read(1)
-                    if(mode == "0"):
-                        blk_type += mode + bs.read(12)
-                    else:
-                        blk_type += mode + bs.read(8)
-                elif(blk_type == "001"):
-                    blk_type+=bs.read(4)
-                elif(blk_type == "111"):
-                    leng = bs.read(16)
-                    blk_type+=leng
-                    blk_type += bs.read(self.read_int(leng)*8)
-                    depth -= 1
-                chunk += blk_type
-                depth += 1
-                if(debug):
-                    print(f"{blk_type}; depth = {depth}")
-            elif op == "110":
-                if(debug):
-                    print("depth =", depth)
-                depth -= 1
-                if depth == 0:
-                    break
+    def closed_loop(self, op, a, count, body, r):
+        """Leave the registers as running a REP/FOR/VFR loop would.
+
+        a is the loop's counter (REP) or variable (FOR/VFR), count its trip
+        count (at least 1), body its single record and r the page's slots."""
+        regs = self.regs
+        bop, d, s, _ = body
+        v = regs[r[d]]
+        if op != OP_REP and d == a:
+            # the loop resets its variable after every iteration, so only
+            # the write of the last one (made with the variable at count) stays
+            v = _closed_step(bop, count, count if s == a else regs[r[s]])
+        elif bop == OP_INC:
+            v = (v + count) & 0xFF
+        elif bop == OP_DEC:
+            v = (v - count) & 0xFF
+        elif s == d:                            # ADD/SUB/MUL d d
+            if bop == OP_ADD:
+                v = v * pow(2, count, 1 << 32)
+            elif bop == OP_SUB:
+                v = 0
             else:
-                # other opcodes: need to read their operands
-                chunk += self.read_operands_for(op, bs)
-        return chunk
-
-    def read_operands_for(self, op, bs):
-        """Reads correct operand bit count for a *non-block* opcode."""
-        if op == "000": return ""
-        if op == "001": return bs.read(3+4)
-        if op == "010": return bs.read(3)
-        if op == "011": 
-            mode = bs.read(3)
-            if(mode == "101"):
-                n = (bs.read(2))
-                opnds = mode + n + bs.read(4) + bs.read(8*(self.read_int(n)+1))
+                for _ in range(min(count, 32)):  # fixed after 32 squarings mod 2**32
+                    v = v * v & 0xFFFFFFFF
+        elif op != OP_REP and s == a:           # d += / -= / *= 1, 2, ..., count
+            if bop == OP_MUL:
+                for n in range(2, min(count, 34) + 1):  # 34! is 0 mod 2**32
+                    v = v * n & 0xFFFFFFFF
             else:
-                opnds= mode + bs.read(8)
-            return opnds
-        if op == "100": 
-            mode = bs.read(2)
-            if(int(mode, 2) < 3):
-                return mode + bs.read(4)
-            return mode + bs.read(8)
-        if op == "111": 
-            iocd = bs.read(2)
-            if iocd == "10" or iocd == "11":
-                return iocd + bs.read(4)
-            return iocd
-        return ""
-
-    def handle_block(self, bs, debug):
-        """Processes a %blok instruction."""
-        blk_type = self.read_int(bs.read(3))
-
-        # ---------------------------------------------------------
-        # 000 IF %addr %cond %addr … 110
-        # ---------------------------------------------------------
-        if blk_type == 0:
-            a1 = self.read_int(bs.read(4))
-            cond = self.read_int(bs.read(2))
-            a2 = self.read_int(bs.read(4))
-            body_bits = self.collect_block(bs, debug)
-            if self.cond(cond, a1, a2):
-                self.run(BitStream(body_bits))
-
-        # ---------------------------------------------------------
-        # 001 REPEAT %addr … 110
-        # ---------------------------------------------------------
-        elif blk_type == 1:
-            count = self.get(self.read_int(bs.read(4)))
-            body_bits = self.collect_block(bs, debug)
-            for _ in range(count):
-                self.run(BitStream(body_bits))
-
-        # ---------------------------------------------------------
-        # 010 function definition
-        # ---------------------------------------------------------
-        elif blk_type == 2:
-            fid = self.read_int(bs.read(4))
-            body_bits = self.collect_block(bs, debug)
-            self.functions[fid] = body_bits
-
-        # ---------------------------------------------------------
-        # 011 undefine function (immediate)
-        # ---------------------------------------------------------
-        elif blk_type == 3:
-            fid = self.read_int(bs.read(4))
-            self.functions[fid] = ""  # no-op
-
-        # ---------------------------------------------------------
-        # 100 call function (immediate, no block end)
-        # ---------------------------------------------------------
-        elif blk_type == 4:
-            fid = self.read_int(bs.read(4))
-            if fid in self.functions:
-                self.run(BitStream(self.functions[fid]))
-
-        # ---------------------------------------------------------
-        # 101 FOR %addr %intg … 110
-        # ---------------------------------------------------------
-        elif blk_type == 5:
-            mode = self.read_int(bs.read(1))
-            addr = self.read_int(bs.read(4))
-            if(mode == 0):
-                count = self.read_int(bs.read(8))
+                total = count * (count + 1) // 2
+                v = v + total if bop == OP_ADD else v - total
+        else:
+            vs = regs[r[s]]
+            if bop == OP_ADD:
+                v = v + count * vs
+            elif bop == OP_SUB:
+                v = v - count * vs
             else:
-                count = self.get(self.read_int(bs.read(4)))
-            body_bits = self.collect_block(bs,debug)
-            for i in range(1, count+1):
-                self.set(addr, i)
-                self.run(BitStream(body_bits))
-
-        # ---------------------------------------------------------
-        # 110 WHILE %cond … 110
-        # ---------------------------------------------------------
-        elif blk_type == 6:
-            adra = self.read_int(bs.read(4))
-            cond = self.read_int(bs.read(2))
-            adrb = self.read_int(bs.read(4))
-            body_bits = self.collect_block(bs, debug)
-            while self.cond(cond, adra, adrb):
-                self.run(BitStream(body_bits))
-
-        # ---------------------------------------------------------
-        # 111 DPM 
-        # ---------------------------------------------------------
-        elif blk_type == 7:
-            leng = self.read_int(bs.read(16))
-            utf = b""
-            for c in range(leng):
-                utf+=int(bs.read(8), 2).to_bytes(1)
-            print(utf.decode("utf-8"))
+                v = v * pow(vs, count, 1 << 32)
+        regs[r[d]] = v & 0xFFFFFFFF
+        if op != OP_REP and d != a:
+            regs[r[a]] = count
+
+    def closed_while(self, a, cond, b, body, r):
+        """Run WHL a cond b [ INC/DEC a ] in one step, its condition being true,
+        and return the number of iterations that took.
+
+        Returns 0, leaving the loop to run as written, when the 8-bit
+        INC/DEC would never make the condition false."""
+        regs = self.regs
+        va = regs[r[a]]
+        vb = regs[r[b]]
+        if cond == 1:                           # a <= b, counting up to b + 1
+            if vb >= 0xFF:
+                return 0
+            regs[r[a]] = vb + 1
+            return vb + 1 - va
+        elif cond == 3:                         # a != b, wrapping round to b
+            if vb > 0xFF:
+                return 0
+            regs[r[a]] = vb
+            return ((vb - va if body[0] == OP_INC else va - vb) & 0xFF) or 0x100
+        else:                                   # a >= b, counting down to b - 1
+            if vb == 0:
+                return 0
+            v = (va - 1) & 0xFF
+            regs[r[a]] = v if v < vb else vb - 1
+            return v - vb + 2 if v >= vb else 1
+
+    # ---------------------------------------------------------
+    # Handle I/O codes
+    # ---------------------------------------------------------
+    def handle_iocd(self, op, addr):
+        # EXO and ERR end execute's loop, so only input is left here
+        if op == OP_INH:  # await hex -> store in addr
+            self.output.flush()
+            val = int(self.input("hex> "), 16)
+            self.set(addr, val)
+
+        elif op == OP_IND:  # await binary -> store in addr
+            self.output.flush()
+            val = int(self.input("dec> "), 10)
+            self.set(addr, val)
 
 
 # =============================================================
 # END OF VM
-# =============================================================
\ No newline at end of file
+# =============================================================
+
+
+def _lines(text, sink):
+    """An input function reading text a line at a time, showing its
+    prompts in sink the way a terminal would."""
+    lines = iter(text.splitlines())
+
+    def read(prompt=""):
+        sink.write(prompt)
+        for line in lines:
+            return line
+        raise EOFError("EOF when reading a line")
+    return read
+
+
+def runProgram(bitcode, input=None, output=None, **options):
+    """Run a program without side effects on the process: no exit(), and
+    no reading stdin or writing stdout unless asked to.
+
+    bitcode is anything VM accepts, a decoded Program included. input is a
+    function taking a prompt and returning a line, or text to read lines
+    from (none by default: INH/IND then fail with EOFError). output is a
+    function or stream to write to; by default the output is captured in
+    the result. options go to VM. An error in the program, or in loading
+    it (a bad path, an unclosed block), ends the run with status 1 and the
+    exception as the result's error; registers are then None if the
+    program never started."""
+    captured = io.StringIO() if output is None else None
+    sink = OutputSink(output if captured is None else captured)
+    if input is None or isinstance(input, str):
+        input = _lines(input or "", sink)
+    vm = None
+    try:
+        vm = VM(bitcode, output=sink, input=input, **options)
+        result = vm.run()
+    except Exception as e:
+        if vm is None:
+            result = RunResult(1, None, [], error=e)
+        else:
+            result = RunResult(1, vm.registers(), list(vm.stack), error=e)
+    if captured is not None:
+        result.output = captured.getvalue()
+    return result
@@ -0,0 +1,226 @@
+# =============================================================
+#   SmolBit benchmark suite
+# =============================================================
+# Times the compiler (splitCode / convert), the syntax checker, VM
+# loading and VM execution on a fixed set of programs and prints the
+# results as JSON, so runs of different releases can be compared:
+#
+#   python bench.py --src ../SmolBit-2.0.4.post3/src -o old.json
+#   python bench.py --src ../SmolBit-2.0.5/src -o new.json
+#   python bench.py compare old.json new.json
+#
+# The programs only use instructions every release understands (LDI
+# rather than LD2-LD4, DPI "..." rather than DPM) so the same sources
+# run unchanged on 2.0.4.post3 and later.
+
+import argparse
+import contextlib
+import inspect
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# -------------------------------------------------------------
+# Programs
+# -------------------------------------------------------------
+# The syntax checker has no notion of ; comments, so the sources below
+# are described here rather than inside the programs themselves.
+
+# count to 255 with a WHL loop, 40 times
+WHL_COUNTER = """
+LDI 1 ff
+FOR 5 28 [
+    CLZ 0
+    WHL 0 ! 1 [ INC 0 ADD 3 0 ]
+]
+"""
+
+# three nested FOR loops, 32 * 32 * 16 iterations
+NESTED_FOR = """
+FOR 0 20 [
+    FOR 1 20 [
+        FOR 2 10 [ ADD 3 2 MUL 4 2 SUB 4 3 ]
+    ]
+]
+"""
+
+# count register 0 down from 150 through recursive calls, 64 times
+RECURSIVE_CLL = """
+CLZ e
+DEF 1 [
+    IF 0 ! e [ DEC 0 CLL 1 INC 3 ]
+]
+FOR 2 40 [ LDI 0 96 CLL 1 ]
+"""
+
+# print 200 rows of numbers and a message after each
+PRINT_HEAVY = """
+FOR 0 c8 [
+    FOR 1 20 [ DPD 1 DPI 20 ]
+    DPI 0a
+    DPI "row done, next row"
+]
+"""
+
+
+def large_source(lines=3000, seed=0):
+    """A long generated program mixing straight-line code, blocks and
+    strings, mainly to stress the compiler and checker."""
+    rng = random.Random(seed)
+    reg = lambda: rng.choice("0123456789abcde")
+    out = []
+    for i in range(lines):
+        k = rng.random()
+        if k < 0.3:
+            out.append(f"{rng.choice(['ADD', 'SUB', 'MUL', 'SET'])} {reg()}{reg()}")
+        elif k < 0.5:
+            out.append(f"LDI {reg()} {rng.randrange(256):02x}")
+        elif k < 0.6:
+            out.append(f"{rng.choice(['INC', 'DEC', 'CLZ', 'CLI'])} {reg()}")
+        elif k < 0.7:
+            out.append(f"IF {reg()} {rng.choice('=<>!')} {reg()} [ INC {reg()} DPD {reg()} ]")
+        elif k < 0.8:
+            out.append(f"FOR {reg()} 03 [ ADD {reg()}{reg()} ]")
+        elif k < 0.88:
+            out.append(f'DPI "line {i}"')
+        else:
+            out.append(f"PG{rng.randint(1, 8)} PG1")
+    return "\n".join(out) + "\n"
+
+
+PROGRAMS = {
+    "whl_counter": WHL_COUNTER,
+    "nested_for": NESTED_FOR,
+    "recursive_cll": RECURSIVE_CLL,
+    "print_heavy": PRINT_HEAVY,
+    "large_source": large_source(),
+}
+
+
+# -------------------------------------------------------------
+# Timing
+# -------------------------------------------------------------
+def import_smolbit(src):
+    """Import the SmolBit package found in a release's src directory."""
+    sys.path.insert(0, os.path.abspath(src))
+    import SmolBit
+    return SmolBit
+
+
+@contextlib.contextmanager
+def quiet():
+    """Send everything printed (program output included) to devnull."""
+    with open(os.devnull, "w") as null, contextlib.redirect_stdout(null):
+        yield
+
+
+def measure(fn, setup=None, repeat=5):
+    """Time fn(setup()) repeat times; setup is not timed."""
+    times = []
+    for _ in range(repeat):
+        arg = setup() if setup else None
+        with quiet():
+            start = time.perf_counter()
+            try:
+                fn(arg)
+            except SystemExit:
+                pass
+            times.append(time.perf_counter() - start)
+    return {"min": min(times), "median": statistics.median(times), "repeat": repeat}
+
+
+def compile_bits(sb, source):
+    """convert() as a '0'/'1' string; later releases return bytes unless asked."""
+    if "as_bits" in inspect.signature(sb.convert).parameters:
+        return sb.convert(source, as_bits=True)
+    return sb.convert(source)
+
+
+def bench_program(sb, source, path, repeat):
+    bits = compile_bits(sb, source)
+    if bits is None:
+        raise ValueError("benchmark program failed to compile")
+    while -len(bits) % 8 % 3:
+        # 2.0.4 decodes the padding of the last byte as opcodes and fails
+        # unless it is a whole number of 3-bit NOPs
+        source += "NOP\n"
+        bits = compile_bits(sb, source)
+    with open(path, "wb") as file:
+        file.write(sb.binaryToBytes(bits))
+    return {
+        "splitCode": measure(lambda _: sb.splitCode(source), repeat=repeat),
+        "convert": measure(lambda _: sb.convert(source), repeat=repeat),
+        "check": measure(lambda _: sb.checker(source).check(), repeat=repeat),
+        "load": measure(lambda _: sb.VM(path), repeat=repeat),
+        "run": measure(lambda vm: vm.run(), lambda: sb.VM(path), repeat=repeat),
+    }
+
+
+def bench(src, names=None, repeat=5):
+    sb = import_smolbit(src)
+    release = os.path.basename(os.path.dirname(os.path.abspath(src)))
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for name in names or PROGRAMS:
+            results[name] = bench_program(sb, PROGRAMS[name], os.path.join(tmp, name + ".smbt"), repeat)
+    return {
+        "release": getattr(sb, "__version__", None) or release,
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "results": results,
+    }
+
+
+# -------------------------------------------------------------
+# Comparing runs
+# -------------------------------------------------------------
+def compare(old, new, key="min"):
+    """Print new/old time ratios for every program and stage both runs share."""
+    print(f"{'program':<16}{'stage':<12}{old['release']:>16}{new['release']:>16}{'ratio':>9}")
+    for name, stages in old["results"].items():
+        for stage, before in stages.items():
+            after = new["results"].get(name, {}).get(stage)
+            if after is None:
+                continue
+            ratio = after[key] / before[key] if before[key] else float("inf")
+            print(f"{name:<16}{stage:<12}{before[key]:>15.6f}s{after[key]:>15.6f}s{ratio:>8.3f}x")
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv and argv[0] == "compare":
+        parser = argparse.ArgumentParser(prog="bench.py compare")
+        parser.add_argument("old")
+        parser.add_argument("new")
+        parser.add_argument("--key", choices=("min", "median"), default="min")
+        args = parser.parse_args(argv[1:])
+        with open(args.old) as a, open(args.new) as b:
+            compare(json.load(a), json.load(b), args.key)
+        return
+
+    parser = argparse.ArgumentParser(prog="bench.py")
+    parser.add_argument("--src", default=os.path.join(HERE, "..", "SmolBit-2.0.5", "src"),
+                        help="src directory of the release to benchmark")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--program", action="append", choices=sorted(PROGRAMS),
+                        help="only run this program (may be repeated)")
+    parser.add_argument("-o", "--output", help="write JSON here instead of stdout")
+    args = parser.parse_args(argv)
+
+    report = json.dumps(bench(args.src, args.program, args.repeat), indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(report + "\n")
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()